@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+'''
+Measure the performance of VCDVCD on a synthetic or given VCD file.
+
+Each benchmark runs in a fresh process, so that its peak RSS is its own.
+Results are printed as a table, and can also be written as JSON with --json,
+and compared against a previous JSON result with --compare.
+
+The legacy_parse function is the line based readline loop that VCDVCD
+used before the block tokenizer, kept here as a throughput baseline.
+'''
+
+from __future__ import print_function
+
+from argparse import ArgumentParser
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from vcdvcd import VCDVCD, StreamParser, StreamParserCallbacks
+import vcdvcd
+
+def _identifier(i):
+    """
+    Short identifier code made of the printable ASCII characters, as simulators do.
+    """
+    chars = []
+    while True:
+        i, r = divmod(i, 94)
+        chars.append(chr(33 + r))
+        if not i:
+            return ''.join(chars)
+        i -= 1
+
+def generate_vcd(
+    path,
+    nscopes=4,
+    nsigs=50,
+    widths=(1, 8),
+    toggle_rate=0.25,
+    nsteps=10000,
+    same_line=0.0,
+    seed=0,
+):
+    """
+    Write a synthetic VCD.
+
+    There is a top scope with a clock that toggles at every time step,
+    and nscopes sub scopes with nsigs signals each, whose widths cycle through widths.
+
+    :param toggle_rate: average fraction of the signals that change at each time step
+    :type toggle_rate: float
+
+    :param same_line: fraction of the time steps whose value changes are written
+                      on the same line as the #time, e.g. ``#10 1! b101 "``
+    :type same_line: float
+
+    :return: number of value changes written
+    :rtype: int
+    """
+    rand = random.Random(seed)
+    nvars = nscopes * nsigs
+    ids = [_identifier(i) for i in range(nvars + 1)]
+    clock = ids[-1]
+    sizes = [widths[i % len(widths)] for i in range(nsigs)] * nscopes
+    nevents = 0
+    with open(path, 'w') as f:
+        f.write('$date synthetic $end\n')
+        f.write('$timescale 1 ns $end\n')
+        f.write('$scope module top $end\n')
+        f.write('$var wire 1 {} clk $end\n'.format(clock))
+        for scope in range(nscopes):
+            f.write('$scope module u{} $end\n'.format(scope))
+            for i in range(nsigs):
+                size = sizes[i]
+                if size == 1:
+                    f.write('$var wire 1 {} s{} $end\n'.format(ids[scope * nsigs + i], i))
+                else:
+                    f.write('$var wire {} {} s{} [{}:0] $end\n'.format(
+                        size, ids[scope * nsigs + i], i, size - 1))
+            f.write('$upscope $end\n')
+        f.write('$upscope $end\n')
+        f.write('$enddefinitions $end\n')
+        f.write('$dumpvars\n')
+        for i in range(nvars):
+            if sizes[i] == 1:
+                f.write('x{}\n'.format(ids[i]))
+            else:
+                f.write('bx {}\n'.format(ids[i]))
+        f.write('0{}\n$end\n'.format(clock))
+        nevents += nvars + 1
+        nchanges = max(int(nvars * toggle_rate), 1)
+        for step in range(1, nsteps + 1):
+            changes = ['{}{}'.format(step % 2, clock)]
+            for i in rand.sample(range(nvars), min(nchanges, nvars)):
+                if sizes[i] == 1:
+                    changes.append('{}{}'.format(rand.choice('01'), ids[i]))
+                else:
+                    changes.append('b{:b} {}'.format(rand.getrandbits(sizes[i]), ids[i]))
+            nevents += len(changes)
+            if rand.random() < same_line:
+                f.write('#{} {}\n'.format(step, ' '.join(changes)))
+            else:
+                f.write('#{}\n{}\n'.format(step, '\n'.join(changes)))
+    return nevents
+
+def legacy_parse(vcd_path):
+    """
+    The per line readline loop, with the per change closure call, signal
+    selection check and callback call that it used to make.
+    """
+    values = set(('0', '1', 'x', 'X', 'z', 'Z'))
+    vector_values = set(('b', 'B', 'r', 'R'))
+    callbacks = StreamParserCallbacks()
+    data = {}
+    cur_sig_vals = {}
+    time = 0
+
+    def add_value_identifier_code(time, value, identifier_code):
+        if identifier_code in data:
+            callbacks.value(
+                None,
+                time=time,
+                value=value,
+                identifier_code=identifier_code,
+                cur_sig_vals=cur_sig_vals
+            )
+            data[identifier_code].append((time, value))
+            cur_sig_vals[identifier_code] = value
+
+    with open(vcd_path, 'r') as vcd_file:
+        while True:
+            line = vcd_file.readline()
+            if line == '':
+                break
+            line0 = line[0]
+            line = line.strip()
+            if line == '':
+                continue
+            if line0 == '#':
+                callbacks.time(None, time, cur_sig_vals)
+                time = int(line.split()[0][1:])
+                for change in filter(None, line.split()[1:]):
+                    add_value_identifier_code(time, change[0], change[1:])
+            elif line0 in vector_values:
+                value, identifier_code = line[1:].split()
+                add_value_identifier_code(time, value, identifier_code)
+            elif line0 in values:
+                add_value_identifier_code(time, line[0], line[1:])
+            elif '$enddefinitions' in line:
+                pass
+            elif '$scope' in line:
+                pass
+            elif '$upscope' in line:
+                pass
+            elif '$var' in line:
+                data[line.split()[3]] = []
+    return data
+
+class CountingCallbacks(StreamParserCallbacks):
+    """
+    Count value changes, to compare the callback path with iter_changes.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def value(self, vcd, time, value, identifier_code, cur_sig_vals):
+        self.count += 1
+
+# Number of operations of the query benchmarks.
+QUERIES = 100000
+SLICES = 100
+REGEX_LOOKUPS = 100
+
+def _parsed(vcd_path):
+    vcd = VCDVCD(vcd_path)
+    signal = max(vcd.data.values(), key=lambda s: len(s.times))
+    return vcd, signal
+
+def _bench_getitem(vcd_path, options):
+    vcd, signal = _parsed(vcd_path)
+    rand = random.Random(0)
+    times = [rand.randrange(vcd.endtime + 1) for i in range(QUERIES)]
+    def run():
+        for t in times:
+            signal[t]
+    return run, QUERIES
+
+def _bench_slice(vcd_path, options):
+    vcd, signal = _parsed(vcd_path)
+    def run():
+        for i in range(SLICES):
+            signal[0:vcd.endtime:7]
+    return run, SLICES
+
+def _bench_regex(vcd_path, options):
+    vcd, signal = _parsed(vcd_path)
+    regexes = [
+        re.compile(r'^{}(\.|$)'.format(re.escape(ref.rsplit('.', 1)[0])))
+        for ref in vcd.signals[:REGEX_LOOKUPS]
+    ]
+    def run():
+        for regex in regexes:
+            vcd[regex]
+    return run, len(regexes)
+
+def _bench_vcdcat(vcd_path, options, deltas=False):
+    def run():
+        with open(os.devnull, 'w') as devnull:
+            if deltas:
+                callbacks = vcdvcd.PrintDeltasStreamParserCallbacks(file=devnull)
+            else:
+                callbacks = vcdvcd.PrintDumpsStreamParserCallbacks(file=devnull)
+            VCDVCD(vcd_path, store_tvs=False, callbacks=callbacks)
+    return run, None
+
+def _selected_signals(vcd_path):
+    signals = VCDVCD(vcd_path, only_sigs=True).signals
+    return signals[::10]
+
+# name: function(vcd_path, options) -> (function to time, number of operations or
+# None if it processes the whole file). Benchmarks that process the whole file report
+# MB/s and value changes/s, the others operations/s.
+BENCHMARKS = {
+    'legacy readline loop': lambda p, o: (lambda: legacy_parse(p), None),
+    'VCDVCD': lambda p, o: (lambda: VCDVCD(p), None),
+    'VCDVCD store_tvs=False': lambda p, o: (lambda: VCDVCD(p, store_tvs=False), None),
+    'VCDVCD signals= 10%': lambda p, o: (
+        lambda signals=_selected_signals(p): VCDVCD(p, signals=signals), None),
+    'VCDVCD only_sigs=True': lambda p, o: (lambda: VCDVCD(p, only_sigs=True), None),
+    'VCDVCD use_mmap=True': lambda p, o: (lambda: VCDVCD(p, use_mmap=True), None),
+    'VCDVCD processes': lambda p, o: (lambda: VCDVCD(p, processes=o['processes']), None),
+    'callbacks': lambda p, o: (
+        lambda: VCDVCD(p, store_tvs=False, callbacks=CountingCallbacks()), None),
+    'iter_changes': lambda p, o: (
+        lambda: sum(len(batch) for batch in StreamParser(store_tvs=False).iter_changes(p)), None),
+    'Signal[time]': _bench_getitem,
+    'Signal[slice]': _bench_slice,
+    'VCDVCD[regex]': _bench_regex,
+    'vcdcat': _bench_vcdcat,
+    'vcdcat --deltas': lambda p, o: _bench_vcdcat(p, o, deltas=True),
+}
+
+def _peak_rss():
+    """
+    :return: peak resident set size of this process in bytes, or None if unknown.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+def run_benchmark(name, vcd_path, repeat, options):
+    """
+    Run one benchmark in the current process.
+
+    :return: best time in seconds over repeat runs, number of operations,
+             and peak RSS of the process in bytes.
+    :rtype: Tuple[float,Union[NoneType,int],Union[NoneType,int]]
+    """
+    func, ops = BENCHMARKS[name](vcd_path, options)
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, ops, _peak_rss()
+
+def _version():
+    info = {'vcdvcd': None, 'commit': None}
+    try:
+        from importlib.metadata import version
+        info['vcdvcd'] = version('vcdvcd')
+    except Exception:
+        pass
+    try:
+        info['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        pass
+    return info
+
+def _count_events(vcd_path):
+    return sum(len(batch) for batch in StreamParser(store_tvs=False).iter_changes(vcd_path))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark VCDVCD.')
+    parser.add_argument('vcd_path', nargs='?',
+        help='VCD file to use. If not given, generate a synthetic one.')
+    parser.add_argument('--nscopes', type=int, default=4)
+    parser.add_argument('--nsigs', type=int, default=50,
+        help='number of signals per scope')
+    parser.add_argument('--widths', type=lambda s: [int(w) for w in s.split(',')], default=[1, 8],
+        help='comma separated bus widths that the signals of each scope cycle through')
+    parser.add_argument('--toggle-rate', type=float, default=0.25,
+        help='average fraction of the signals that change at each time step')
+    parser.add_argument('--nsteps', type=int, default=20000)
+    parser.add_argument('--same-line', type=float, default=0.0,
+        help='fraction of the time steps with their value changes on the #time line')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+        help='number of processes for the VCDVCD(processes=) benchmark')
+    parser.add_argument('-b', '--benchmark', action='append', choices=sorted(BENCHMARKS),
+        help='only run this benchmark, can be given multiple times')
+    parser.add_argument('--json', metavar='PATH',
+        help='also write the results as JSON to this file, - for stdout')
+    parser.add_argument('--compare', metavar='PATH',
+        help='JSON results of a previous run to print the speedup against')
+    args = parser.parse_args()
+    tmpdir = None
+    generator = None
+    if args.vcd_path:
+        vcd_path = args.vcd_path
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        vcd_path = os.path.join(tmpdir.name, 'bench.vcd')
+        generator = {
+            'nscopes': args.nscopes,
+            'nsigs': args.nsigs,
+            'widths': args.widths,
+            'toggle_rate': args.toggle_rate,
+            'nsteps': args.nsteps,
+            'same_line': args.same_line,
+            'seed': args.seed,
+        }
+        generate_vcd(vcd_path, **generator)
+    nbytes = os.path.getsize(vcd_path)
+    nevents = _count_events(vcd_path)
+    log = sys.stderr if args.json == '-' else sys.stdout
+    print('{}: {:.2f} MB, {} value changes'.format(vcd_path, nbytes / 1e6, nevents), file=log)
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {r['name']: r for r in json.load(f)['results']}
+    options = {'processes': args.processes}
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for name in args.benchmark or BENCHMARKS:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            seconds, ops, rss = executor.submit(
+                run_benchmark, name, vcd_path, args.repeat, options).result()
+        result = {'name': name, 'seconds': seconds, 'peak_rss_bytes': rss}
+        if ops is None:
+            result['mb_per_s'] = nbytes / seconds / 1e6
+            result['events_per_s'] = nevents / seconds
+            rate = '{:8.2f} MB/s {:10.0f} events/s'.format(result['mb_per_s'], result['events_per_s'])
+        else:
+            result['ops'] = ops
+            result['ops_per_s'] = ops / seconds
+            rate = '{:26.0f} ops/s'.format(result['ops_per_s'])
+        line = '{:<24s} {:8.3f} s {} {:8.1f} MB RSS'.format(
+            name, seconds, rate, (rss or 0) / 1e6)
+        if name in previous:
+            line += ' {:6.2f}x'.format(previous[name]['seconds'] / seconds)
+        print(line, file=log)
+        results.append(result)
+    if args.json:
+        report = {
+            'version': _version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'input': {
+                'path': None if generator else os.path.abspath(vcd_path),
+                'generator': generator,
+                'bytes': nbytes,
+                'events': nevents,
+            },
+            'repeat': args.repeat,
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+    if tmpdir is not None:
+        tmpdir.cleanup()
@@ -17,6 +17,9 @@ setup(
     author_email='ciro.santilli.contact@gmail.com',
     packages=find_packages(),
     include_package_data=True,
-    scripts=['vcdcat'],
+    scripts=['vcdcat', 'vcdbatch'],
     install_requires=[],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
 )
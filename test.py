@@ -1,11 +1,25 @@
 #!/usr/bin/env python3
 
-import unittest
+import bz2
+import contextlib
+import gzip
+import importlib.util
+import io
+import lzma
+import os
 import re
+import shutil
+import tempfile
+import unittest
 
 from vcdvcd import VCDVCD
 import vcdvcd
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Test(unittest.TestCase):
     SMALL_CLOCK_VCD = '''$var reg 1 " clock $end
 $enddefinitions $end
@@ -143,6 +157,36 @@ $enddefinitions $end
             else:
                 self.assertEqual(int(signal_d,2), ((t - 4)//2)%4)
 
+    def test_select(self):
+        vcd = VCDVCD('counter_tb.vcd', store_scopes=True)
+        self.assertEqual(vcd.select('counter_tb.reset', 'exact'), ['counter_tb.reset'])
+        self.assertEqual(vcd.select('counter_tb.rese', 'exact'), [])
+        self.assertEqual(
+            vcd.select('counter_tb.top.', 'prefix'),
+            ['counter_tb.top.clock', 'counter_tb.top.enable', 'counter_tb.top.reset', 'counter_tb.top.out[1:0]']
+        )
+        self.assertEqual(vcd.select('counter_tb.*', 'glob'), vcd.select('counter_tb.', 'prefix')[:4])
+        self.assertEqual(vcd.select('counter_tb.**.out*', 'glob'), ['counter_tb.out[1:0]', 'counter_tb.top.out[1:0]'])
+        self.assertEqual(vcd.select('**.[ce]*', 'glob'), [
+            'counter_tb.clock', 'counter_tb.enable', 'counter_tb.top.clock', 'counter_tb.top.enable'])
+        for pattern in (
+            r'^counter_tb\.top', r'^counter_tb\.t?op', r'^counter_tb\.to+p', r'^counter_tb\.(top|out)',
+            r'^counter_tb\.top|reset', r'^counter_tb[.]', r'\Acounter_tb\.c', r'res', '^', r'(?i)^COUNTER',
+        ):
+            regex = re.compile(pattern)
+            self.assertEqual(
+                vcd.select(regex, 'regexp'),
+                [ref for ref in vcd.signals if regex.search(ref)],
+                pattern
+            )
+        self.assertEqual(vcdvcd.vcdvcd._regex_literal_prefix(re.compile(r'^a\.b\[1c*')), 'a.b[1')
+        self.assertEqual(vcdvcd.vcdvcd._regex_literal_prefix(re.compile(r'^ab+c')), 'ab')
+        self.assertEqual(vcdvcd.vcdvcd._regex_literal_prefix(re.compile(r'^a(b|c)|d')), '')
+        self.assertEqual(vcdvcd.vcdvcd._regex_literal_prefix(re.compile(r'^a[|]')), 'a')
+        self.assertIs(vcd[re.compile(r'^counter_tb\.to.$')], vcd.scopes['counter_tb.top'])
+        scope = vcd.scopes['counter_tb.top']
+        self.assertEqual(len(scope[re.compile('reset|enable')]), 2)
+
     def test_toplevel_signal(self):
         vcd = VCDVCD(vcd_string=self.SMALL_CLOCK_VCD)
         signal = vcd['clock']
@@ -174,5 +218,727 @@ $enddefinitions $end
         self.assertEqual(D1[30], '1')
         self.assertEqual(D1[35], '0')
 
+    def test_columnar_storage(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        signal = vcd['counter_tb.top.out[1:0]']
+        self.assertEqual(list(signal.times[:3]), [0, 2, 6])
+        self.assertEqual(signal.values[:3], ['x', '0', '1'])
+        self.assertEqual(signal.tv, list(zip(signal.times, signal.values)))
+        # Repeated values share a single entry of the value table.
+        self.assertEqual(len(signal._value_table), 5)
+        signal.tv = [(0, '1'), (5, '0')]
+        self.assertEqual(signal[4], '1')
+        self.assertEqual(signal[5], '0')
+
+    def test_block_boundaries(self):
+        """
+        Tokens, vector value changes and header commands split across
+        blocks must give the same result as a single block.
+        """
+        with open('counter_tb.vcd', 'rb') as f:
+            content = f.read()
+        expect = VCDVCD('counter_tb.vcd', store_scopes=True)
+        for block_size in (1, 2, 3, 7, 64):
+            parser = vcdvcd.StreamParser(store_scopes=True)
+            vcd = parser.vcd
+            for i in range(0, len(content), block_size):
+                parser.feed(content[i:i + block_size])
+            parser.close()
+            self.assertEqual(vcd.signals, expect.signals)
+            self.assertEqual(vcd.references_to_ids, expect.references_to_ids)
+            self.assertEqual(sorted(vcd.scopes), sorted(expect.scopes))
+            self.assertEqual(vcd.timescale, expect.timescale)
+            self.assertEqual(vcd.endtime, expect.endtime)
+            for identifier_code, signal in expect.data.items():
+                self.assertEqual(vcd.data[identifier_code].tv, signal.tv)
+
+    def test_single_line_vector_value_change(self):
+        vcd = VCDVCD(vcd_string='''$var wire 2 ! a $end
+$var wire 1 " b $end
+$enddefinitions $end
+#0 b10 ! 1"
+#5 b01 !
+''')
+        self.assertEqual(vcd['a'].tv, [(0, '10'), (5, '01')])
+        self.assertEqual(vcd['b'].tv, [(0, '1')])
+
+    def test_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            vcd_path = os.path.join(tmpdir, 'counter_tb.vcd')
+            shutil.copy('counter_tb.vcd', vcd_path)
+            cache_path = vcd_path + '.vcdvcd'
+            expect = VCDVCD(vcd_path, store_scopes=True)
+            for i in range(2):
+                vcd = VCDVCD(vcd_path, store_scopes=True, cache=True)
+                self.assertTrue(os.path.exists(cache_path))
+                self.assertEqual(vcd.signals, expect.signals)
+                self.assertEqual(vcd.timescale, expect.timescale)
+                self.assertEqual(vcd['counter_tb.top.out[1:0]'].tv, expect['counter_tb.top.out[1:0]'].tv)
+                self.assertIs(vcd[re.compile('counter_tb.top$')]['clock'], vcd['counter_tb.top.clock'])
+            cache_dir = os.path.join(tmpdir, 'packed')
+            os.mkdir(cache_dir)
+            for i in range(2):
+                vcd = VCDVCD(vcd_path, packed=True, cache=True, cache_dir=cache_dir)
+                self.assertEqual(
+                    [str(v) for v in vcd['counter_tb.top.out[1:0]'].values],
+                    ['xx', '00', '01', '10', '11', '00', '01', '10', '11', '00', '01', '10']
+                )
+
+            # Corrupt index.
+            with open(cache_path, 'r+b') as f:
+                f.seek(30)
+                f.write(b'garbage')
+            vcd = VCDVCD(vcd_path, cache=True)
+            self.assertEqual(vcd['counter_tb.clock'].tv, expect['counter_tb.clock'].tv)
+            with open(cache_path, 'r+b') as f:
+                f.seek(30)
+                f.write(b'garbage')
+            vcd = VCDVCD(vcd_path, cache=True, stats=True)
+            self.assertEqual(vcd.stats.bytes, os.path.getsize(vcd_path))
+            self.assertEqual(VCDVCD(vcd_path, cache=True, stats=True)['counter_tb.clock'].tv, expect['counter_tb.clock'].tv)
+
+            # Stale index.
+            with open(vcd_path, 'a') as f:
+                f.write('#27\n0"\n')
+            os.utime(vcd_path, ns=(0, 0))
+            vcd = VCDVCD(vcd_path, cache=True)
+            self.assertEqual(vcd.endtime, 27)
+            self.assertEqual(vcd['counter_tb.clock'][27], '0')
+
+            # Separate cache directory.
+            cache_dir = os.path.join(tmpdir, 'cache')
+            os.mkdir(cache_dir)
+            VCDVCD(vcd_path, cache=True, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_lazy(self):
+        checkpoint_bytes = vcdvcd.vcdvcd._LazyIndex.CHECKPOINT_BYTES
+        block_size = vcdvcd.StreamParser.BLOCK_SIZE
+        vcdvcd.vcdvcd._LazyIndex.CHECKPOINT_BYTES = 64
+        vcdvcd.StreamParser.BLOCK_SIZE = 16
+        try:
+            expect = VCDVCD('counter_tb.vcd')
+            vcd = VCDVCD('counter_tb.vcd', lazy=True)
+            self.assertGreater(len(vcd['counter_tb.clock']._index.offsets), 2)
+            self.assertEqual(vcd.signals, expect.signals)
+            self.assertEqual(vcd.endtime, expect.endtime)
+            for identifier_code, signal in vcd.data.items():
+                expect_signal = expect.data[identifier_code]
+                self.assertIsInstance(signal, vcdvcd.LazySignal)
+                for t in range(-1, expect.endtime + 2):
+                    self.assertEqual(signal[t], expect_signal[t])
+                self.assertFalse(signal.loaded)
+                self.assertEqual(signal.tv, expect_signal.tv)
+                self.assertTrue(signal.loaded)
+                self.assertEqual(signal[0:30], expect_signal[0:30])
+
+            # Block boundaries right after the # of a time.
+            tmpdir = tempfile.mkdtemp()
+            try:
+                vcd_path = os.path.join(tmpdir, 'times.vcd')
+                with open(vcd_path, 'w') as f:
+                    f.write('$var wire 1 ! a $end\n$enddefinitions $end\n')
+                    for time in range(0, 400, 10):
+                        f.write('#{}\n{}!\n'.format(time, time // 10 % 2))
+                expect = VCDVCD(vcd_path)['a']
+                for vcdvcd.StreamParser.BLOCK_SIZE in range(8, 24):
+                    signal = VCDVCD(vcd_path, lazy=True)['a']
+                    for t in range(0, 400, 5):
+                        self.assertEqual(signal[t], expect[t])
+            finally:
+                shutil.rmtree(tmpdir)
+        finally:
+            vcdvcd.vcdvcd._LazyIndex.CHECKPOINT_BYTES = checkpoint_bytes
+            vcdvcd.StreamParser.BLOCK_SIZE = block_size
+
+    def test_processes(self):
+        min_chunk_bytes = vcdvcd.vcdvcd._PARALLEL_MIN_CHUNK_BYTES
+        vcdvcd.vcdvcd._PARALLEL_MIN_CHUNK_BYTES = 32
+        try:
+            for path in ('counter_tb.vcd', 'negator_tb.vcd'):
+                expect = VCDVCD(path)
+                vcd = VCDVCD(path, processes=2)
+                self.assertEqual(vcd.signals, expect.signals)
+                self.assertEqual(vcd.begintime, expect.begintime)
+                self.assertEqual(vcd.endtime, expect.endtime)
+                for identifier_code, signal in expect.data.items():
+                    self.assertEqual(vcd.data[identifier_code].tv, signal.tv)
+                    self.assertEqual(vcd.data[identifier_code].endtime, signal.endtime)
+        finally:
+            vcdvcd.vcdvcd._PARALLEL_MIN_CHUNK_BYTES = min_chunk_bytes
+
+    def test_mmap(self):
+        block_size = vcdvcd.StreamParser.BLOCK_SIZE
+        try:
+            for vcdvcd.StreamParser.BLOCK_SIZE in (block_size, 5):
+                for path in ('counter_tb.vcd', 'negator_tb.vcd'):
+                    expect = VCDVCD(path)
+                    for kwargs in ({}, {'lazy': True}, {'processes': 1}):
+                        vcd = VCDVCD(path, use_mmap=True, **kwargs)
+                        self.assertEqual(vcd.signals, expect.signals)
+                        self.assertEqual(vcd.endtime, expect.endtime)
+                        for identifier_code, signal in expect.data.items():
+                            self.assertEqual(vcd.data[identifier_code][3], signal[3])
+                            self.assertEqual(vcd.data[identifier_code].tv, signal.tv)
+        finally:
+            vcdvcd.StreamParser.BLOCK_SIZE = block_size
+        vcd = VCDVCD(vcd_string=self.SINGLE_LINE_VALUE_CHANGE_VCD.rstrip())
+        self.assertEqual(vcd.endtime, 40)
+        with tempfile.NamedTemporaryFile(suffix='.vcd') as f:
+            vcd = VCDVCD(f.name, use_mmap=True)
+            self.assertEqual(vcd.signals, [])
+
+    def test_compressed(self):
+        with open('counter_tb.vcd', 'rb') as f:
+            content = f.read()
+        expect = VCDVCD('counter_tb.vcd')
+        expect_out = io.StringIO()
+        with contextlib.redirect_stdout(expect_out):
+            VCDVCD('counter_tb.vcd', store_tvs=False, callbacks=vcdvcd.PrintDumpsStreamParserCallbacks())
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for ext, compress in (('gz', gzip.compress), ('bz2', bz2.compress), ('xz', lzma.compress)):
+                path = os.path.join(tmpdir, 'counter_tb.vcd.' + ext)
+                with open(path, 'wb') as f:
+                    f.write(compress(content))
+                vcd = VCDVCD(path)
+                for identifier_code, signal in expect.data.items():
+                    self.assertEqual(vcd.data[identifier_code].tv, signal.tv)
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    VCDVCD(path, store_tvs=False, callbacks=vcdvcd.PrintDumpsStreamParserCallbacks())
+                self.assertEqual(out.getvalue(), expect_out.getvalue())
+                with self.assertRaises(ValueError):
+                    VCDVCD(path, lazy=True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sample(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        signal = vcd['counter_tb.top.out[1:0]']
+        for r in (range(0, 30), range(-3, 40, 7), range(1, 25, 2), range(29, -1, -3), range(5, 5)):
+            expect = [signal[max(t, 0)] if t >= 0 else None for t in r]
+            self.assertEqual(signal.sample(r), expect)
+            if r.step > 0:
+                self.assertEqual(signal.sample(list(r)), expect)
+            if numpy is not None and r.step > 0:
+                self.assertEqual(signal.sample(numpy.array(r, dtype=numpy.int64)).tolist(), expect)
+        self.assertEqual(signal[3:20:4], [signal[t] for t in range(3, 20, 4)])
+
+    def test_time_window(self):
+        expect = VCDVCD('counter_tb.vcd')
+        for start_time, end_time in ((7, 13), (6, 12), (0, 3), (None, 5), (20, None), (30, 40)):
+            vcd = VCDVCD('counter_tb.vcd', start_time=start_time, end_time=end_time)
+            lo = 0 if start_time is None else start_time
+            hi = expect.endtime if end_time is None else min(end_time, expect.endtime)
+            self.assertLessEqual(vcd.endtime, max(hi, lo))
+            for identifier_code, signal in vcd.data.items():
+                for time in signal.times:
+                    self.assertGreaterEqual(time, lo)
+                    self.assertLessEqual(time, max(hi, lo))
+                for t in range(lo, hi + 1):
+                    self.assertEqual(signal[t], expect.data[identifier_code][t])
+
+        # start_time between times, with and without a time in the window after it.
+        class Callbacks(vcdvcd.StreamParserCallbacks):
+            def __init__(self):
+                self.steps = []
+            def time(self, vcd, time, cur_sig_vals):
+                self.steps.append((time, cur_sig_vals['!'], cur_sig_vals['"']))
+        vcd_string = '''$var wire 1 ! a $end
+$var wire 1 " b $end
+$enddefinitions $end
+#0
+1!
+0"
+#10
+0!
+#20
+1!
+1"
+#30
+0!
+'''
+        for end_time, steps in ((15, [(12, '0', '0')]), (25, [(12, '0', '0'), (20, '1', '1')])):
+            callbacks = Callbacks()
+            vcd = VCDVCD(vcd_string=vcd_string, start_time=12, end_time=end_time, callbacks=callbacks)
+            self.assertEqual(callbacks.steps, steps)
+            self.assertEqual(vcd['a'].tv[0], (12, '0'))
+
+        # Window after the end of the file.
+        vcd = VCDVCD('counter_tb.vcd', start_time=30)
+        self.assertEqual(vcd.endtime, expect.endtime)
+        self.assertEqual(vcd['counter_tb.clock'].tv, [])
+        self.assertIsNone(vcd['counter_tb.clock'][30])
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            VCDVCD('counter_tb.vcd', signals=['counter_tb.out[1:0]'], start_time=7, end_time=12,
+                   callbacks=vcdvcd.PrintDeltasStreamParserCallbacks())
+        self.assertEqual(out.getvalue(), '8 2 counter_tb.out[1:0]\n10 3 counter_tb.out[1:0]\n12 0 counter_tb.out[1:0]\n')
+
+    def test_follow(self):
+        class Callbacks(vcdvcd.StreamParserCallbacks):
+            def __init__(self):
+                self.times = []
+                self.values = []
+            def time(self, vcd, time, cur_sig_vals):
+                self.times.append(time)
+            def value(self, vcd, time, value, identifier_code, cur_sig_vals):
+                self.values.append((time, value, identifier_code))
+        with open('counter_tb.vcd', 'rb') as f:
+            content = f.read()
+        expect = VCDVCD('counter_tb.vcd')
+        callbacks = Callbacks()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'counter_tb.vcd')
+            # Start in the middle of the header, and cut anywhere in lines.
+            cuts = [100, 460, 461, 500, 677, len(content)]
+            with open(path, 'wb') as f:
+                f.write(content[:cuts[0]])
+            with VCDVCD(path, follow=True, callbacks=callbacks) as vcd:
+                self.assertEqual(vcd.signals, [])
+                for start, end in zip(cuts, cuts[1:]):
+                    with open(path, 'ab') as f:
+                        f.write(content[start:end])
+                    self.assertEqual(vcd.update(), end - start)
+                self.assertEqual(vcd.update(), 0)
+            self.assertEqual(vcd.signals, expect.signals)
+            self.assertEqual(vcd.endtime, expect.endtime)
+            for identifier_code, signal in expect.data.items():
+                self.assertEqual(vcd.data[identifier_code].tv, signal.tv)
+            self.assertEqual(callbacks.times, [0] + list(range(0, expect.endtime + 1)))
+            self.assertEqual(len(callbacks.values), sum(len(signal.times) for signal in expect.data.values()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_iter_changes(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        expect = sorted(
+            (time, identifier_code, value)
+            for identifier_code, signal in vcd.data.items()
+            for time, value in signal.tv
+        )
+        parser = vcdvcd.StreamParser(store_tvs=False)
+        events = [e for batch in parser.iter_changes('counter_tb.vcd') for e in batch]
+        self.assertEqual(sorted(events), expect)
+        self.assertEqual(parser.vcd.signals, vcd.signals)
+        batches = list(vcdvcd.StreamParser().iter_changes('counter_tb.vcd', batch_size=7))
+        self.assertEqual([e for batch in batches for e in batch], events)
+        self.assertTrue(all(len(batch) == 7 for batch in batches[:-1]))
+        # Many changes on the last line, without a newline, are parsed by close.
+        last_line = io.BytesIO(b'$var wire 1 ! a $end $enddefinitions $end #0 ' + b'0! 1! ' * 10)
+        batches = list(vcdvcd.StreamParser().iter_changes(last_line, batch_size=7))
+        self.assertEqual([len(batch) for batch in batches], [7, 7, 6])
+        times = list(vcdvcd.StreamParser().iter_times('counter_tb.vcd'))
+        self.assertEqual([t for t, changes in times], sorted(set(e[0] for e in events)))
+        self.assertEqual(
+            [(t, i, v) for t, changes in times for i, v in changes],
+            events
+        )
+
+        # Stopping the iteration stops reading the file.
+        block_size = vcdvcd.StreamParser.ITER_BLOCK_SIZE
+        vcdvcd.StreamParser.ITER_BLOCK_SIZE = 64
+        try:
+            with open('counter_tb.vcd', 'rb') as f:
+                parser = vcdvcd.StreamParser()
+                it = parser.iter_times(f)
+                self.assertEqual(next(it)[0], 0)
+                it.close()
+                self.assertLess(f.tell(), os.path.getsize('counter_tb.vcd'))
+                self.assertIsNone(parser._events)
+        finally:
+            vcdvcd.StreamParser.ITER_BLOCK_SIZE = block_size
+
+    def test_search(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        clock = vcd['counter_tb.clock']
+        out = vcd['counter_tb.out[1:0]']
+        self.assertEqual(clock.next_change(0), (1, '0'))
+        self.assertEqual(clock.next_change(0.5), (1, '0'))
+        self.assertEqual(clock.previous_change(1), (0, '1'))
+        self.assertIsNone(clock.previous_change(0))
+        self.assertIsNone(clock.next_change(clock.times[-1]))
+        self.assertEqual(list(clock.rising_edges()), list(range(2, 27, 2)))
+        self.assertEqual(list(clock.falling_edges(5, 11)), [5, 7, 9, 11])
+        self.assertEqual(list(out.find_all('1')), [6, 14, 22])
+        self.assertEqual(out.find_first('1', start=7), 14)
+        self.assertIsNone(out.find_first('1', start=23))
+        self.assertIsNone(out.find_first('101'))
+        self.assertEqual(list(out.find_all(lambda v: v in ('10', '11'), 9, 20)), [10, 16, 18])
+
+        # Verilog edges on the lowest bit, including x and z.
+        signal = vcdvcd.Signal('2', 'wire')
+        for time, value in enumerate(['0', 'x', '1', '1', '10', 'z', '0', '11', 'x1', '0']):
+            signal.append(time, value)
+        self.assertEqual(list(signal.rising_edges()), [1, 2, 5, 7])
+        self.assertEqual(list(signal.falling_edges()), [4, 6, 9])
+        self.assertEqual(list(signal.find_all('1')), [2, 3])
+        # The per value index follows appended value changes.
+        signal.append(10, '1')
+        self.assertEqual(list(signal.find_all('1')), [2, 3, 10])
+        self.assertEqual(list(signal.rising_edges(start=3)), [5, 7, 10])
+
+    def test_summarize(self):
+        signal = VCDVCD('counter_tb.vcd')['counter_tb.top.out[1:0]']
+        self.assertEqual(signal.summarize(0, 28, 7), [
+            (2, 'x', '0', 0, 0, True),
+            (1, '0', '1', 0, 1, False),
+            (2, '10', '11', 2, 3, False),
+            (2, '0', '1', 0, 1, False),
+            (2, '10', '11', 2, 3, False),
+            (2, '0', '1', 0, 1, False),
+            (1, '10', '10', 2, 2, False),
+        ])
+        self.assertEqual(signal.summarize(9, 10, 1), [(0, '10', '10', 2, 2, False)])
+        self.assertEqual(signal.summarize(-4, 0, 2), [(0, None, None, None, None, False)] * 2)
+        # Brute force over all buckets of a longer signal.
+        signal = vcdvcd.Signal('3', 'wire')
+        for time in range(0, 300, 3):
+            signal.append(time, ['1', '101', 'x1', '0', '111', '10'][time % 7 % 6])
+        for start, end, buckets in ((0, 300, 7), (5, 297, 13), (0, 300, 300)):
+            for b, (changes, first, last, low, high, unknown) in enumerate(signal.summarize(start, end, buckets)):
+                a = start + (end - start) * b // buckets
+                z = start + (end - start) * (b + 1) // buckets
+                values = [signal[time] for time in range(a, z)]
+                self.assertEqual(changes, sum(1 for time in signal.times if a <= time < z))
+                self.assertEqual((first, last), (values[0], values[-1]))
+                self.assertEqual(unknown, any('x' in v for v in values))
+                known = [int(v, 2) for v in values if 'x' not in v]
+                self.assertEqual((low, high), (min(known), max(known)) if known else (None, None))
+        # Several value changes at the start of a bucket, the last one is in effect.
+        signal = vcdvcd.Signal('2', 'wire')
+        for time, value in ((0, '0'), (4, '11'), (4, '1'), (4, '10'), (6, '0')):
+            signal.append(time, value)
+        self.assertEqual(signal.summarize(4, 8, 2), [
+            (3, '10', '10', 2, 2, False),
+            (1, '0', '0', 0, 0, False),
+        ])
+        # More buckets than times, empty buckets take the value in effect.
+        self.assertEqual(signal.summarize(3, 7, 8), [
+            (0, '0', '0', 0, 0, False),
+            (0, '0', '0', 0, 0, False),
+            (0, '10', '10', 2, 2, False),
+            (3, '10', '10', 2, 2, False),
+            (0, '10', '10', 2, 2, False),
+            (0, '10', '10', 2, 2, False),
+            (0, '0', '0', 0, 0, False),
+            (1, '0', '0', 0, 0, False),
+        ])
+
+    def test_packed(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        packed = VCDVCD('counter_tb.vcd', packed=True)
+        self.assertIs(type(packed['counter_tb.clock']), vcdvcd.Signal)
+        out = packed['counter_tb.out[1:0]']
+        self.assertIsInstance(out, vcdvcd.PackedSignal)
+        self.assertEqual(out.times, vcd['counter_tb.out[1:0]'].times)
+        self.assertEqual(
+            [str(v) for v in out.values],
+            ['xx', '00', '01', '10', '11', '00', '01', '10', '11', '00', '01', '10']
+        )
+        self.assertEqual(out[8], 2)
+        self.assertEqual(int(out[11]), 3)
+        self.assertFalse(out[0].known)
+        self.assertEqual(list(out.find_all(1)), [6, 14, 22])
+        # Repeated values are interned on their packed bits.
+        self.assertEqual(len(out._value_table), 5)
+        self.assertEqual(list(out._codes), [0, 1, 2, 3, 4, 1, 2, 3, 4, 1, 2, 3])
+        self.assertEqual(out.find_first('11', start=11), 18)
+        self.assertEqual(list(out.rising_edges(end=10)), [6, 10])
+
+        value = vcdvcd.FourStateValue.from_string('z1x0', 8)
+        self.assertEqual(str(value), 'zzzzz1x0')
+        self.assertEqual((value.bits, value.xz), (0b00000110, 0b11111010))
+        self.assertEqual(value.hex(), 'z')
+        self.assertEqual(vcdvcd.FourStateValue.from_string('x01', 4).hex(), 'x')
+        self.assertEqual(vcdvcd.FourStateValue.from_string('101', 8).hex(), '5')
+        self.assertEqual(vcdvcd.FourStateValue.from_string('101', 8), vcdvcd.FourStateValue(3, 5))
+        self.assertNotEqual(value, vcdvcd.FourStateValue.from_string('z1x1', 8))
+        self.assertEqual(len(set([value, vcdvcd.FourStateValue.from_string('z1x0', 8), 5, vcdvcd.FourStateValue(3, 5)])), 2)
+        with self.assertRaises(ValueError):
+            int(value)
+
+        # Past the limit of distinct values, values are appended without interning.
+        intern_limit = vcdvcd.vcdvcd._PackedValues.INTERN_LIMIT
+        vcdvcd.vcdvcd._PackedValues.INTERN_LIMIT = 2
+        try:
+            out = VCDVCD('counter_tb.vcd', packed=True)['counter_tb.out[1:0]']
+        finally:
+            vcdvcd.vcdvcd._PackedValues.INTERN_LIMIT = intern_limit
+        self.assertIsNone(out._value_table.index)
+        self.assertEqual(len(out._value_table), 12)
+        self.assertEqual(out[8], 2)
+        self.assertEqual(list(out.find_all(1)), [6, 14, 22])
+
+        wide = '''$var wire 200 ! a $end
+$enddefinitions $end
+#0
+b1 !
+#1
+b''' + '1' * 200 + ''' !
+#2
+bx1 !
+'''
+        signal = VCDVCD(vcd_string=wide, packed=True)['a']
+        self.assertEqual(signal.values, [1, (1 << 200) - 1, vcdvcd.FourStateValue(200, (1 << 200) - 1, (1 << 200) - 2)])
+        self.assertEqual(signal._value_table.nbytes, 25)
+
+    def test_print_callbacks(self):
+        out = io.StringIO()
+        VCDVCD(
+            'counter_tb.vcd',
+            signals=['counter_tb.top.enable', 'counter_tb.top.reset'],
+            store_tvs=False,
+            callbacks=vcdvcd.PrintDumpsStreamParserCallbacks(file=out),
+        )
+        self.assertEqual(out.getvalue(), '''0 time
+1 counter_tb.top.enable
+2 counter_tb.top.reset
+
+0 1 2 
+=====
+0 0 0
+1 0 1
+3 0 0
+5 1 0
+25 0 0
+''')
+        out = io.StringIO()
+        vcd = VCDVCD(
+            'counter_tb.vcd',
+            callbacks=vcdvcd.PrintDeltasStreamParserCallbacks(file=out),
+        )
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[:2], ['0 x counter_tb.top.out[1:0]', '0 0 counter_tb.reset'])
+        self.assertEqual(lines[-1], '26 1 counter_tb.clock')
+        self.assertEqual(len(lines), sum(len(signal.times) for signal in vcd.data.values()))
+
+    def test_write_vcd(self):
+        signals = ['counter_tb.top.out[1:0]', 'counter_tb.clock']
+        for store_scopes in (False, True):
+            out = io.StringIO()
+            VCDVCD(
+                'counter_tb.vcd',
+                signals=signals,
+                store_tvs=False,
+                store_scopes=store_scopes,
+                start_time=10,
+                end_time=20,
+                callbacks=vcdvcd.WriteVCDStreamParserCallbacks(out, start_time=10),
+            )
+            self.assertIn('$scope module top $end\n$var reg 2 % out [1:0] $end\n$upscope $end', out.getvalue())
+            extract = VCDVCD(vcd_string=out.getvalue())
+            expected = VCDVCD('counter_tb.vcd', signals=signals, start_time=10, end_time=20)
+            self.assertEqual(extract.signals, expected.signals)
+            for reference in signals:
+                self.assertEqual(extract[reference].tv, expected[reference].tv)
+
+        # String and real values round trip.
+        vcd_string = '''$scope module t $end
+$var string 1 ! msg $end
+$var real 64 " r $end
+$upscope $end
+$enddefinitions $end
+#0
+sidle !
+r0.5 "
+#5
+sbusy !
+#9
+sdone !
+r1.25 "
+'''
+        out = io.StringIO()
+        VCDVCD(vcd_string=vcd_string, store_tvs=False, start_time=6,
+               callbacks=vcdvcd.WriteVCDStreamParserCallbacks(out, start_time=6))
+        self.assertIn('$dumpvars\nsbusy !\nr0.5 "\n$end\n', out.getvalue())
+        extract = VCDVCD(vcd_string=out.getvalue())
+        self.assertEqual(extract['t.msg'].tv, [(6, 'busy'), (9, 'done')])
+        self.assertEqual(extract['t.r'].tv, [(6, '0.5'), (9, '1.25')])
+
+    def test_diff(self):
+        with open('counter_tb.vcd') as f:
+            golden = f.read()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'b.vcd')
+            with open(path, 'w') as f:
+                # Wrong value, and same values written with different lengths.
+                f.write(golden.replace('#14\nb1 !', '#14\nb11 !').replace('b0 %', 'b00 %').replace('\n#4\n', '\n#4\nb10 %\n'))
+            self.assertEqual(list(vcdvcd.VCDDiff('counter_tb.vcd', 'counter_tb.vcd')), [])
+            with vcdvcd.VCDDiff('counter_tb.vcd', path) as diff:
+                self.assertEqual(len(diff.references), 8)
+                self.assertEqual(list(diff), [
+                    (4, 'counter_tb.top.out[1:0]', '0', '10'),
+                    (14, 'counter_tb.out[1:0]', '1', '11'),
+                ])
+            diff = vcdvcd.VCDDiff('counter_tb.vcd', path, signals=['counter_tb.out[1:0]', 'counter_tb.nope'])
+            self.assertEqual(diff.references, ['counter_tb.out[1:0]'])
+            self.assertEqual(len(list(diff)), 1)
+            self.assertEqual(len(list(vcdvcd.VCDDiff('counter_tb.vcd', path, max_mismatches=1))), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_batch(self):
+        summary = vcdvcd.SignalSummary(['counter_tb.clock', 'negator_tb.out'], 'exact', [0, 5])
+        paths = ['counter_tb.vcd', 'negator_tb.vcd', 'nope.vcd']
+        for processes in (1, 2):
+            results = {path: (result, error) for path, result, error in vcdvcd.iter_batch(paths, summary, processes=processes)}
+            self.assertEqual(results['counter_tb.vcd'], ({'counter_tb.clock': {'changes': 27, 'last': '1', 'values': ['1', '0']}}, None))
+            self.assertEqual(results['negator_tb.vcd'][0]['negator_tb.out']['changes'], 11)
+            self.assertIsNone(results['nope.vcd'][0])
+            self.assertIsInstance(results['nope.vcd'][1], FileNotFoundError)
+        results = list(vcdvcd.iter_batch('counter_tb.vc?', callbacks=vcdvcd.StreamParserCallbacks(), store_tvs=False))
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0][1], vcdvcd.StreamParserCallbacks)
+        # Each file gets its own copy of the callbacks, also in process.
+        callbacks = vcdvcd.PrintDeltasStreamParserCallbacks(file=io.StringIO())
+        for processes in (1, 2):
+            results = dict(
+                (path, result) for path, result, error in
+                vcdvcd.iter_batch(paths[:2], callbacks=callbacks, store_tvs=False, processes=processes)
+            )
+            self.assertIsNot(results['counter_tb.vcd'], results['negator_tb.vcd'])
+            self.assertEqual(len(results['counter_tb.vcd']._out._file.getvalue().splitlines()), 57)
+            self.assertEqual(len(results['negator_tb.vcd']._out._file.getvalue().splitlines()), 22)
+        self.assertEqual(callbacks._out._file.getvalue(), '')
+
+    def test_activity(self):
+        activity = vcdvcd.ActivityStats('counter_tb.vcd')
+        self.assertEqual(activity.signals['counter_tb.clock'], {
+            'changes': 27, 'toggles': 26, 'time_0': 13, 'time_1': 13, 'time_x': 0, 'duty_cycle': 0.5,
+        })
+        out = activity.signals['counter_tb.top.out[1:0]']
+        self.assertEqual((out['toggles'], out['time_0'], out['time_1'], out['time_x']), (15, 8, 16, 2))
+        self.assertIs(activity.signals['counter_tb.top.clock'], activity.signals['counter_tb.clock'])
+        self.assertEqual([reference for reference, _ in activity.hottest(2)], ['counter_tb.clock', 'counter_tb.out[1:0]'])
+        self.assertEqual(activity.scopes['counter_tb.top'], {'signals': 4, 'changes': 45, 'toggles': 45})
+        # clock counts once in counter_tb, even though it is also in counter_tb.top.
+        self.assertEqual(activity.scopes['counter_tb'], {'signals': 5, 'changes': 57, 'toggles': 60})
+        window = vcdvcd.ActivityStats('counter_tb.vcd', signals=['counter_tb.top.out[1:0]'], start_time=10, end_time=20)
+        self.assertEqual(window.signals['counter_tb.top.out[1:0]']['time_1'], 8)
+        self.assertEqual(window.signals['counter_tb.top.out[1:0]']['time_0'], 2)
+        # Signals without a duty cycle, such as reals, come last.
+        unknown = vcdvcd.ActivityStats(vcd_string='''$var real 64 ! a $end
+$var wire 1 " b $end
+$enddefinitions $end
+#0
+r0.5 !
+0"
+#2
+r1.5 !
+1"
+#4
+''')
+        self.assertIsNone(unknown.signals['a']['duty_cycle'])
+        self.assertEqual([reference for reference, _ in unknown.hottest(key='duty_cycle')], ['b', 'a'])
+
+    def test_stats(self):
+        progress = []
+        vcd = VCDVCD('counter_tb.vcd', stats=True, progress=lambda done, total: progress.append((done, total)))
+        stats = vcd.stats
+        size = os.path.getsize('counter_tb.vcd')
+        self.assertEqual(stats.bytes, size)
+        self.assertEqual(progress[-1], (size, size))
+        self.assertEqual(stats.events, sum(len(signal.times) for signal in vcd.data.values()))
+        self.assertEqual(stats.most_active(1), [(vcd['counter_tb.clock'].references[0], 27)])
+        self.assertGreater(stats.store_bytes, 0)
+        streamed = VCDVCD('counter_tb.vcd', store_tvs=False, stats=True).stats
+        self.assertEqual(streamed.signal_changes, stats.signal_changes)
+        self.assertIsNone(VCDVCD('counter_tb.vcd').stats)
+
+    def test_memory_budget(self):
+        expected = VCDVCD('counter_tb.vcd')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            vcd = VCDVCD('counter_tb.vcd', memory_budget=120, spill_dir=tmpdir)
+            self.assertEqual(os.listdir(tmpdir), [])
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertIsInstance(vcd['counter_tb.clock'].times, memoryview)
+        for identifier_code, signal in expected.data.items():
+            spilled = vcd.data[identifier_code]
+            self.assertEqual(list(spilled.times), list(signal.times))
+            self.assertEqual(spilled.values, signal.values)
+        signal = vcd['counter_tb.top.out[1:0]']
+        self.assertEqual(signal[13], expected['counter_tb.top.out[1:0]'][13])
+        self.assertEqual(signal[0:6], expected['counter_tb.top.out[1:0]'][0:6])
+        self.assertEqual(list(signal.find_all('10')), list(expected['counter_tb.top.out[1:0]'].find_all('10')))
+        with self.assertRaises(ValueError):
+            VCDVCD('counter_tb.vcd', memory_budget=120, packed=True)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_to_numpy(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        signal = vcd['counter_tb.top.out[1:0]']
+        times, values, mask = signal.to_numpy()
+        self.assertEqual(times.tolist(), list(signal.times))
+        self.assertEqual(values.tolist(), [0, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2])
+        self.assertEqual(mask.tolist(), [True] + [False] * 11)
+
+        vcd = VCDVCD(vcd_string='''$var wire 70 ! a $end
+$var real 64 " r $end
+$var realtime 64 # t $end
+$enddefinitions $end
+#0
+b1 !
+r1.5 "
+r2.5 #
+#1
+b1''' + '0' * 69 + ''' !
+''')
+        times, values, mask = vcd['a'].to_numpy()
+        self.assertEqual(values.tolist(), [1, 1 << 69])
+        times, values, mask = vcd['r'].to_numpy()
+        self.assertEqual(values.tolist(), [1.5])
+        times, values, mask = vcd['t'].to_numpy()
+        self.assertEqual(values.tolist(), [2.5])
+        self.assertEqual(vcd['t'].summarize(0, 2, 1), [(1, '2.5', '2.5', 2.5, 2.5, False)])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_table(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        refs = ['counter_tb.reset', 'counter_tb.enable', 'counter_tb.out[1:0]']
+        table = vcd.table(refs)
+        self.assertEqual(list(table.dtype.names), ['time'] + refs)
+        self.assertEqual(table['time'].tolist()[:6], [0, 1, 2, 3, 5, 6])
+        for row in table:
+            for ref in refs:
+                self.assertEqual(row[ref], vcd[ref][int(row['time'])])
+        self.assertEqual(
+            vcd.table(re.compile(r'^counter_tb\.(reset|enable)$')).dtype.names,
+            ('time', 'counter_tb.enable', 'counter_tb.reset')
+        )
+
+    @unittest.skipIf(importlib.util.find_spec('pandas') is None, 'pandas is not installed')
+    def test_table_pandas(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        refs = ['counter_tb.reset', 'counter_tb.enable', 'counter_tb.out[1:0]']
+        table = vcd.table(refs)
+        df = vcd.table(refs, pandas=True)
+        self.assertEqual(df.index.tolist(), table['time'].tolist())
+        self.assertEqual(df['counter_tb.out[1:0]'].tolist(), table['counter_tb.out[1:0]'].tolist())
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_expand_signal(self):
+        vcd = VCDVCD('counter_tb.vcd')
+        tv = vcdvcd.condition_signal_tv(vcd['counter_tb.top.out[1:0]'].tv[1:6])
+        self.assertEqual(tv, [(2, 0), (6, 1), (8, 2), (10, 3), (12, 0)])
+        x, y = zip(*tv)
+        self.assertEqual(
+            vcdvcd.expand_signal(x, y),
+            ([2, 6, 6, 8, 8, 10, 10, 12, 12, 12], [0, 0, 1, 1, 2, 2, 3, 3, 0, 0])
+        )
+        self.assertEqual(
+            vcdvcd.expand_signal(x, y, 9),
+            ([2, 6, 6, 8, 8, 8], [0, 0, 1, 1, 2, 2])
+        )
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,29 @@
 from __future__ import print_function
 
 import bisect
+import bz2
+import fnmatch
+import concurrent.futures
+import copy
+import glob
+import gzip
+import hashlib
+import heapq
 import io
+from array import array
 import json
+import lzma
 import math
+import mmap
+import operator
+import os
+import pickle
 import re
+import sys
+import tempfile
 from decimal import Decimal
 from pprint import PrettyPrinter
+from time import perf_counter
 
 # https://stackoverflow.com/questions/53978542/how-to-use-collections-abc-from-both-python-3-8-and-python-2-7/53978543#53978543
 try:
@@ -21,7 +38,7 @@ class VCDVCD(object):
 
     # Verilog standard terminology.
     _VALUE = set(('0', '1', 'x', 'X', 'z', 'Z'))
-    _VECTOR_VALUE_CHANGE = set(('b', 'B', 'r', 'R'))
+    _VECTOR_VALUE_CHANGE = set(('b', 'B', 'r', 'R', 's', 'S'))
 
     def __init__(
         self,
@@ -32,6 +49,19 @@ class VCDVCD(object):
         store_scopes=False,
         callbacks=None,
         vcd_string=None,
+        cache=False,
+        cache_dir=None,
+        lazy=False,
+        processes=None,
+        use_mmap=False,
+        start_time=None,
+        end_time=None,
+        follow=False,
+        packed=False,
+        stats=False,
+        progress=None,
+        memory_budget=None,
+        spill_dir=None,
     ):
         """
         Parse a VCD file, and store information about it in this object.
@@ -74,7 +104,10 @@ class VCDVCD(object):
         :vartype timescale: Dict
 
         :type vcd_path: str
-        :param vcd_path: path to the VCD file to parse
+        :param vcd_path: path to the VCD file to parse.
+                         gzip, bzip2, xz and zstd compressed files are detected
+                         from their first bytes and decompressed while parsing.
+                         zstd requires the zstandard package.
 
         :param store_tv: if False, don't store time values in the data
                          Still parse them sequentially however, which may
@@ -108,10 +141,350 @@ class VCDVCD(object):
         :param vcd_string: use this string as the VCD content instead of vcd_path.
                            vcd_path is ignored.
         :type vcd_string: Union[NoeType,str]
+
+        :param cache: if True, store the parsed result in a binary index file,
+                      and load it instead of parsing on later opens of the same file.
+                      The index is keyed on the path, size and modification time of the VCD
+                      and on the signals and store_scopes options. Stale or corrupt
+                      indexes are detected and rebuilt. The index only holds data,
+                      so loading an untrusted one cannot run code.
+                      Ignored unless parsing a vcd_path with store_tvs and without callbacks or only_sigs.
+        :type cache: bool
+
+        :param cache_dir: directory in which to put index files. If None, the index
+                          is put next to the VCD as ``<vcd_path>.vcdvcd``.
+        :type cache_dir: Union[NoneType,str]
+
+        :param lazy: if True, only parse the header and build a sparse index of
+                     the value changes section, and parse the value changes of
+                     each signal only when that signal is first accessed, see :class:`LazySignal`.
+                     Requires vcd_path and is incompatible with callbacks.
+        :type lazy: bool
+
+        :param processes: if given, parse the value changes section in parallel
+                          with this many worker processes. The header is parsed first,
+                          the rest of the file is split into chunks at #time boundaries,
+                          and the per signal value changes of each chunk are merged in order.
+                          Requires vcd_path and is incompatible with callbacks and lazy.
+        :type processes: int
+
+        :param use_mmap: if True, memory map vcd_path and decode it in place one block at a time,
+                         instead of reading it into intermediate buffers. Lazy signals and
+                         parallel workers then also map the file, and share the page cache.
+        :type use_mmap: bool
+
+        :param start_time: if given, value changes before this time are not stored
+                           and do not trigger callbacks, only the current value of each
+                           signal is tracked. Signals that changed before start_time
+                           get their value at start_time stored as a change at start_time.
+                           If the file ends before start_time, nothing is stored, and
+                           endtime is the last time of the file.
+        :type start_time: int
+
+        :param end_time: if given, stop reading the file at the first time greater than this.
+        :type end_time: int
+
+        :param follow: if True, parse what is currently in vcd_path, but keep the file open
+                       and the parser state, so that data appended to the file later on,
+                       e.g. by a running simulation, can be parsed with :func:`update`.
+                       Call :func:`close` once done. Requires an uncompressed vcd_path,
+                       and is incompatible with lazy and processes.
+        :type follow: bool
+
+        :param packed: if True, store the values of vectors packed in bits, see :class:`PackedSignal`,
+                       which takes about one byte per 8 bits instead of one per bit,
+                       and get them as :class:`FourStateValue` instead of strings.
+                       Single bit and real variables are not affected. Incompatible with lazy.
+        :type packed: bool
+
+        :ivar stats: parse statistics if stats is True, None otherwise.
+        :vartype stats: ParseStats
+
+        :param stats: if True, fill :attr:`stats` while parsing. This adds
+                      a small per block cost, plus a per value change cost
+                      if there are value callbacks or store_tvs is False.
+                      Nothing at all is measured if False.
+        :type stats: bool
+
+        :param progress: function called as ``progress(bytes_done, bytes_total)``
+                         after each parsed block, e.g. to show a progress bar.
+                         bytes_total is None for compressed files, for which
+                         bytes_done counts decompressed bytes.
+        :type progress: Callable[[int,Union[NoneType,int]],Any]
+
+        :param memory_budget: if given, bound the memory used by the stored value changes
+                              to about this many bytes, at 12 bytes per value change.
+                              Whenever parsing goes over it, the value changes of the
+                              signals with the most changes are moved to a temporary file,
+                              and once parsing is over, the times and value codes of those
+                              signals are read back through a read-only memory mapping of it.
+                              Reads are transparent, but the
+                              mapped signals can't be appended to. The tables of distinct
+                              values of each signal stay in memory and are not counted, so
+                              memory is not bounded for signals whose values are mostly
+                              distinct, e.g. wide buses or reals. The cache is not used.
+                              Incompatible with lazy, follow and packed.
+        :type memory_budget: int
+
+        :param spill_dir: directory for the temporary files of memory_budget,
+                          the default temporary directory if None.
+        :type spill_dir: str
+        """
+        self._reset()
+        if lazy and (vcd_string is not None or callbacks is not None):
+            raise ValueError('lazy requires vcd_path and does not support callbacks')
+        if processes is not None and (vcd_string is not None or callbacks is not None or lazy):
+            raise ValueError('processes requires vcd_path and does not support callbacks or lazy')
+        if (lazy or processes is not None) and (start_time is not None or end_time is not None):
+            raise ValueError('lazy and processes do not support start_time and end_time')
+        if (lazy or processes is not None) and _detect_compression(vcd_path) is not None:
+            raise ValueError('lazy and processes require random access, and do not support compressed files')
+        if lazy and packed:
+            raise ValueError('lazy does not support packed')
+        if follow and (
+            vcd_string is not None or
+            lazy or
+            processes is not None or
+            _detect_compression(vcd_path) is not None
+        ):
+            raise ValueError('follow requires an uncompressed vcd_path, and does not support lazy or processes')
+        if memory_budget is not None and (lazy or follow or packed):
+            raise ValueError('memory_budget does not support lazy, follow or packed')
+        if stats:
+            self.stats = ParseStats()
+            start = perf_counter()
+        if (
+            cache and
+            not lazy and
+            not follow and
+            memory_budget is None and
+            vcd_string is None and
+            store_tvs and
+            callbacks is None and
+            not only_sigs
+        ):
+            key = self._cache_key(vcd_path, signals, store_scopes, start_time, end_time, packed)
+            cache_path = self._cache_path(vcd_path, cache_dir, key)
+            if self._load_cache(cache_path, key):
+                if stats:
+                    self.stats.total_seconds = perf_counter() - start
+                    self.stats._collect(self, True)
+                return
+        else:
+            cache_path = None
+        if progress is not None:
+            if vcd_string is not None:
+                total_bytes = len(vcd_string.encode('utf-8'))
+            elif _detect_compression(vcd_path) is None:
+                total_bytes = os.path.getsize(vcd_path)
+            else:
+                total_bytes = None
+        else:
+            total_bytes = None
+        parser = StreamParser(
+            self,
+            only_sigs=only_sigs,
+            signals=signals,
+            store_tvs=store_tvs and not lazy,
+            store_scopes=store_scopes,
+            callbacks=callbacks,
+            start_time=start_time,
+            end_time=end_time,
+            packed=packed,
+            stats=self.stats,
+            progress=progress,
+            total_bytes=total_bytes,
+            memory_budget=memory_budget,
+            spill_dir=spill_dir,
+        )
+        if follow:
+            self._parser = parser
+            self._follow_file = open(vcd_path, 'rb')
+            self.update()
+        elif lazy:
+            self._parse_lazy(vcd_path, parser, use_mmap)
+        elif processes is not None:
+            self._parse_parallel(vcd_path, parser, processes, use_mmap)
+        elif vcd_string is not None:
+            parser.feed_buffer(vcd_string.encode('utf-8'))
+            parser.close()
+        else:
+            with _open_vcd(vcd_path, use_mmap) as vcd_file:
+                parser.parse(vcd_file)
+        if stats:
+            self.stats.total_seconds = perf_counter() - start
+            self.stats._collect(self, parser.store_tvs)
+        if cache_path is not None:
+            self._write_cache(cache_path, key)
+
+    def update(self):
+        """
+        Parse the data appended to the file since the last call, for objects
+        created with ``follow=True``.
+
+        An incomplete last line is kept until the rest of it is written. New value
+        changes are appended to the existing signals, and callbacks are called
+        for them as usual, except for the time callback of the last time, which
+        is only called once the next time is seen, or by :func:`close`.
+
+        :return: number of new bytes parsed
+        :rtype: int
+        """
+        nbytes = 0
+        parser = self._parser
+        if self.stats is not None:
+            start = perf_counter()
+        while not parser.done:
+            n = parser.feed_file(self._follow_file, StreamParser.BLOCK_SIZE)
+            if not n:
+                break
+            nbytes += n
+        for aSignal in self.data.values():
+            aSignal.endtime = self.endtime
+        if self.stats is not None:
+            self.stats.total_seconds += perf_counter() - start
+            self.stats._collect(self, parser.store_tvs)
+        return nbytes
+
+    def close(self):
+        """
+        Stop following the file of an object created with ``follow=True``:
+        parse any incomplete last line and call the last time callback.
+        """
+        if self._follow_file is not None:
+            self.update()
+            self._parser.close()
+            self._follow_file.close()
+            self._follow_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _parse_header(vcd_file, parser):
+        """
+        Feed the header line by line so that we know exactly where the body starts.
+
+        :return: byte offset at which the body starts
+        :rtype: int
         """
+        while parser.in_header and not parser.done:
+            line = vcd_file.readline()
+            if not line:
+                break
+            parser.feed(line)
+        return vcd_file.tell() - len(parser._tail)
+
+    def _parse_parallel(self, vcd_path, parser, processes, use_mmap):
+        with _open_vcd(vcd_path, use_mmap) as vcd_file:
+            body_offset = self._parse_header(vcd_file, parser)
+            parser._tail = b''
+            if parser.done:
+                parser.close()
+                return
+            size = os.path.getsize(vcd_path)
+            chunk_size = max(
+                (size - body_offset) // (4 * processes),
+                _PARALLEL_MIN_CHUNK_BYTES
+            )
+            cuts = [body_offset]
+            while True:
+                cut = _find_time_line(vcd_file, cuts[-1] + chunk_size, size)
+                if cut is None:
+                    break
+                cuts.append(cut)
+            cuts.append(size)
+        identifier_codes = list(self.data.keys())
+        for signal in self.data.values():
+            signal._seed_values(_PARALLEL_SEED_VALUES)
+        args = [
+            (
+                vcd_path, start, end, identifier_codes, parser.time,
+                parser.store_tvs, use_mmap, parser.stats is not None,
+            )
+            for start, end in zip(cuts, cuts[1:])
+        ]
+        if len(args) == 1:
+            results = map(_parse_chunk, args)
+            executor = None
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+            results = executor.map(_parse_chunk, args)
+        try:
+            for chunk_args, (begintime, endtime, signal_changed, chunk_data, chunk_stats) in zip(args, results):
+                if parser._instrumented:
+                    lines = None
+                    if chunk_stats is not None:
+                        lines, changes = chunk_stats
+                        signal_changes = parser.stats.signal_changes
+                        for identifier_code, count in changes.items():
+                            signal_changes[identifier_code] = signal_changes.get(identifier_code, 0) + count
+                    parser._account(chunk_args[2] - chunk_args[1], lines)
+                if endtime is None:
+                    continue
+                if parser._first_time:
+                    self.begintime = begintime
+                    parser._first_time = False
+                self.endtime = endtime
+                parser.time = endtime
+                self.signal_changed = signal_changed
+                changes = 0
+                for identifier_code, (times, codes, value_table, last_value) in chunk_data.items():
+                    signal = self.data[identifier_code]
+                    if times:
+                        changes += len(times) // 8
+                        signal.times.frombytes(times)
+                        remap = [signal._value_codes.get(v) for v in value_table]
+                        for i, code in enumerate(remap):
+                            if code is None:
+                                remap[i] = signal._intern(value_table[i])
+                        if remap == list(range(len(remap))):
+                            signal._codes.frombytes(codes)
+                        else:
+                            chunk_codes = array('I')
+                            chunk_codes.frombytes(codes)
+                            signal._codes.extend(array('I', map(remap.__getitem__, chunk_codes)))
+                    parser.cur_sig_vals[identifier_code] = last_value
+                if parser._spill is not None:
+                    parser._spill.check(self.data, changes)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        parser.close()
+
+    def _parse_lazy(self, vcd_path, parser, use_mmap):
+        index = _LazyIndex(vcd_path, use_mmap)
+        cur_sig_vals = parser.cur_sig_vals
+        with _open_vcd(vcd_path, use_mmap) as vcd_file:
+            self._parse_header(vcd_file, parser)
+            if not parser.done:
+                for identifier_code, signal in self.data.items():
+                    lazy_signal = LazySignal(signal.size, signal.var_type, index, identifier_code)
+                    lazy_signal.references = signal.references
+                    self.data[identifier_code] = lazy_signal
+                # From now on, cur_sig_vals only holds values changed since the last checkpoint.
+                cur_sig_vals.clear()
+                offset = vcd_file.tell() - len(parser._tail)
+                index.add(offset, parser.time, {})
+                last_offset = offset
+                while parser.feed_file(vcd_file, StreamParser.BLOCK_SIZE):
+                    offset = vcd_file.tell() - len(parser._tail)
+                    if (
+                        offset - last_offset >= index.CHECKPOINT_BYTES and
+                        parser._command is None and
+                        parser._vector_value is None
+                    ):
+                        index.add(offset, parser.time, dict(cur_sig_vals))
+                        cur_sig_vals.clear()
+                        last_offset = offset
+        parser.close()
+
+    def _reset(self):
         self.hierarchy = {}
         self.scopes    = {}
-        scopes_stack = [self.hierarchy]
         self.data = {}
         self.endtime = 0
         self.begintime = 0
@@ -119,152 +492,171 @@ class VCDVCD(object):
         self.signals = []
         self.timescale = {}
         self.signal_changed = False
+        self._names = _NameIndex()
+        self.stats = None
+        self._parser = None
+        self._follow_file = None
+
+    # Bump whenever the index file contents change.
+    _CACHE_MAGIC = b'VCDVCD-INDEX-2\n'
+
+    @staticmethod
+    def _cache_key(vcd_path, signals, store_scopes, start_time, end_time, packed):
+        st = os.stat(vcd_path)
+        return (
+            os.path.abspath(vcd_path),
+            st.st_size,
+            st.st_mtime_ns,
+            tuple(signals or ()),
+            bool(store_scopes),
+            start_time,
+            end_time,
+            bool(packed),
+            sys.byteorder,
+            array('q').itemsize,
+            array('I').itemsize,
+        )
 
-        self._store_tvs = store_tvs
-
-        if signals is None:
-            signals = []
-        if callbacks is None:
-            callbacks = StreamParserCallbacks()
-        all_sigs = not signals
-        cur_sig_vals = {}
-        hier = []
-        num_sigs = 0
-        time = 0
-        first_time = True
-
-        def handle_value_change(line):
-            value = line[0]
-            identifier_code = line[1:]
-            self._add_value_identifier_code(
-                time, value, identifier_code, cur_sig_vals, callbacks)
-
-        def handle_vector_value_change(line):
-            value, identifier_code = line[1:].split()
-            self._add_value_identifier_code(
-                time, value, identifier_code, cur_sig_vals, callbacks)
+    @staticmethod
+    def _cache_path(vcd_path, cache_dir, key):
+        if cache_dir is None:
+            return vcd_path + '.vcdvcd'
+        digest = hashlib.sha1(repr(key[:1] + key[3:]).encode('utf-8')).hexdigest()
+        return os.path.join(cache_dir, digest + '.vcdvcd')
 
-        if vcd_string is not None:
-            vcd_file = io.StringIO(vcd_string)
-        else:
-            vcd_file = open(vcd_path, 'r')
-        while True:
-            line = vcd_file.readline()
-            if line == '':
-                break
-            line0 = line[0]
-            line = line.strip()
-            if line == '':
-                continue
-            if line0 == '#':
-                callbacks.time(self, time, cur_sig_vals)
-                time = int(line.split()[0][1:])
-                if first_time:
-                    self.begintime = time
-                    first_time = False
-                self.endtime = time
-                self.signal_changed = False
-                # If value change happens on same line, handle them here
-                changes = list(filter(None, line.split()[1:]))
-                if len(changes) > 0:
-                    for change in changes:
-                        if change[0] in self._VALUE:
-                            handle_value_change(change)
-                        elif change[0] in  self._VECTOR_VALUE_CHANGE:
-                            # This is not supported by this simple parser,
-                            # because the value and identifier are separated by
-                            # whitespace
-                            raise Exception("Vector value changes have to be on a separate line!")
-            elif line0 in self._VECTOR_VALUE_CHANGE:
-                handle_vector_value_change(line)
-            elif line0 in self._VALUE:
-                handle_value_change(line)
-            elif '$enddefinitions' in line:
-                if only_sigs:
-                    break
-                callbacks.enddefinitions(self, signals, cur_sig_vals)
-            elif '$scope' in line:
-                scope_name = line.split()[2]
-                hier.append(scope_name)
-
-                if store_scopes:
-                    full_scope_name              = '.'.join(hier)
-                    new_scope                    = Scope(full_scope_name,self)
-                    scopes_stack[-1][scope_name] = new_scope
-                    self.scopes[full_scope_name] = new_scope
-                    scopes_stack.append(new_scope)
-            elif '$upscope' in line:
-                hier.pop()
-                if store_scopes:
-                    scopes_stack.pop()
-            elif '$var' in line:
-                ls = line.split()
-                type = ls[1]
-                size = ls[2]
-                identifier_code = ls[3]
-                name = ''.join(ls[4:-1])
-                path = '.'.join(hier)
-                if path:
-                    reference = path + '.' + name
-                else:
-                    reference = name
-                if store_scopes:
-                    scopes_stack[-1][name] = reference
-                if (reference in signals) or all_sigs:
-                    self.signals.append(reference)
-                    if identifier_code not in self.data:
-                        self.data[identifier_code] = Signal(size, type)
-                    self.data[identifier_code].references.append(reference)
-                    self.references_to_ids[reference] = identifier_code
-                    cur_sig_vals[identifier_code] = 'x'
-            elif '$timescale' in line:
-                if not '$end' in line:
-                    while True:
-                        line += " " + vcd_file.readline().strip().rstrip()
-                        if '$end'  in line:
-                            break
-                timescale = ' '.join(line.split()[1:-1])
-                magnitude = Decimal(re.findall(r"\d+|$", timescale)[0])
-                if magnitude not in [1, 10, 100]:
-                    print("Error: Magnitude of timescale must be one of 1, 10, or 100. "\
-                        + "Current magnitude is: {}".format(magnitude))
-                    exit(-1)
-                unit      = re.findall(r"s|ms|us|ns|ps|fs|$", timescale)[0]
-                factor = {
-                    "s":  '1e0',
-                    "ms": '1e-3',
-                    "us": '1e-6',
-                    "ns": '1e-9',
-                    "ps": '1e-12',
-                    "fs": '1e-15',
-                }[unit]
-                self.timescale["timescale"] = magnitude * Decimal(factor)
-                self.timescale["magnitude"] = magnitude
-                self.timescale["unit"]   = unit
-                self.timescale["factor"] = Decimal(factor)
-        callbacks.time(self, time, cur_sig_vals)
-        for aSignal in filter( lambda x: isinstance(x, Signal),self.data.values()):
-            aSignal.endtime = self.endtime
-        vcd_file.close()
+    def _load_cache(self, cache_path, key):
+        """
+        The index is a JSON header followed by the raw bytes of the arrays of
+        each signal, so that loading it can never run code, unlike e.g. pickle.
 
-    def _add_value_identifier_code(
-        self, time, value, identifier_code,
-        cur_sig_vals, callbacks
-    ):
-        # May not be there due to signal selection.
-        if identifier_code in self.data:
-            callbacks.value(
-                self,
-                time=time,
-                value=value,
-                identifier_code=identifier_code,
-                cur_sig_vals=cur_sig_vals
-            )
-            entry = self.data[identifier_code]
-            self.signal_changed = True
-            if self._store_tvs:
-                entry.tv.append((time, value))
-            cur_sig_vals[identifier_code] = value
+        :return: True if a valid index was loaded into this object.
+        :rtype: bool
+        """
+        try:
+            with open(cache_path, 'rb') as f:
+                if f.read(len(self._CACHE_MAGIC)) != self._CACHE_MAGIC:
+                    return False
+                size = int.from_bytes(f.read(8), 'little')
+                state = json.loads(f.read(size).decode('utf-8'))
+                if state['key'] != json.loads(json.dumps(key)):
+                    return False
+                sections = []
+                for size in state['sections']:
+                    section = f.read(size)
+                    if len(section) != size:
+                        raise ValueError('truncated index')
+                    sections.append(section)
+            self._set_cache_state(state, sections)
+        except Exception:
+            # Parse from scratch instead, still measuring it if asked to.
+            stats = self.stats
+            self._reset()
+            self.stats = stats
+            return False
+        return True
+
+    def _write_cache(self, cache_path, key):
+        state, sections = self._get_cache_state()
+        state['key'] = key
+        state['sections'] = [len(section) for section in sections]
+        header = json.dumps(state).encode('utf-8')
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self._CACHE_MAGIC)
+                f.write(len(header).to_bytes(8, 'little'))
+                f.write(header)
+                for section in sections:
+                    f.write(section)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # The cache is only an optimization, e.g. the directory may be read-only.
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _get_cache_state(self):
+        """
+        :return: JSON serializable state, and the raw sections it refers to by index
+        :rtype: Tuple[dict,List[bytes]]
+        """
+        def elements(d):
+            return [
+                (k, v.name if isinstance(v, Scope) else None, v if isinstance(v, str) else None)
+                for k, v in d.items()
+            ]
+        sections = []
+        def section(data):
+            sections.append(data)
+            return len(sections) - 1
+        data = []
+        for identifier_code, signal in self.data.items():
+            value_table = signal._value_table
+            if isinstance(value_table, _PackedValues):
+                # Bits as a section, and the few xz masks as [index, mask] pairs.
+                values = {
+                    'size': value_table.size,
+                    'bits': section(bytes(value_table.bits)),
+                    'xz': sorted(value_table.xz.items()),
+                }
+            else:
+                values = value_table
+            data.append((
+                identifier_code,
+                signal.size,
+                signal.var_type,
+                signal.references,
+                section(signal.times.tobytes()),
+                section(signal._codes.tobytes()),
+                values,
+            ))
+        return {
+            'begintime': self.begintime,
+            'data': data,
+            'endtime': self.endtime,
+            'hierarchy': elements(self.hierarchy),
+            'references_to_ids': self.references_to_ids,
+            'scopes': [(name, elements(scope.subElements)) for name, scope in self.scopes.items()],
+            'signals': self.signals,
+            # Decimals, except for the unit.
+            'timescale': {k: str(v) for k, v in self.timescale.items()},
+        }, sections
+
+    def _set_cache_state(self, state, sections):
+        self.begintime = state['begintime']
+        self.endtime = state['endtime']
+        self.references_to_ids = state['references_to_ids']
+        self.signals = state['signals']
+        for reference in self.signals:
+            self._names.add_signal(reference)
+        self.timescale = {
+            k: v if k == 'unit' else Decimal(v)
+            for k, v in state['timescale'].items()
+        }
+        for identifier_code, size, var_type, references, times, codes, values in state['data']:
+            if isinstance(values, dict):
+                signal = PackedSignal(size, var_type)
+                value_table = _PackedValues(values['size'])
+                value_table.bits = bytearray(sections[values['bits']])
+                value_table.xz = {i: xz for i, xz in values['xz']}
+                signal._value_table = value_table
+            else:
+                signal = Signal(size, var_type)
+                signal._value_table = values
+                signal._value_codes = {v: i for i, v in enumerate(values)}
+            signal.references = references
+            signal.times.frombytes(sections[times])
+            signal._codes.frombytes(sections[codes])
+            signal.endtime = self.endtime
+            self.data[identifier_code] = signal
+        for name, _ in state['scopes']:
+            self.scopes[name] = Scope(name, self)
+            self._names.add_scope(name)
+        def fill(d, elements):
+            for k, scope_name, reference in elements:
+                d[k] = self.scopes[scope_name] if scope_name is not None else reference
+        fill(self.hierarchy, state['hierarchy'])
+        for name, elements in state['scopes']:
+            fill(self.scopes[name], elements)
 
     def __getitem__(self, refname):
         """
@@ -275,13 +667,8 @@ class VCDVCD(object):
         :rtype: Signal
         """
         if isinstance(refname, _RE_TYPE):
-            l = []
-            for aSignal in self.signals:
-                if ( refname.search(aSignal)):
-                    l.append(aSignal)
-            for aScope in self.scopes:
-                if ( refname.search(aScope)):
-                    l.append(aScope)
+            signals, scopes = self._names.regex(refname)
+            l = signals + scopes
             if len(l) == 1:
                 return self[l[0]]
             return l
@@ -293,6 +680,94 @@ class VCDVCD(object):
             raise KeyError(refname)
 
 
+    def select(self, pattern, mode='substring'):
+        """
+        Select signal references by name.
+
+        Except for substring matching, queries go through a trie of the
+        dotted hierarchy, so only the matching part of the hierarchy is
+        visited.
+
+        :param pattern: what to match the references against
+        :type pattern: Union[str,re.Pattern]
+
+        :param mode: one of:
+
+                     - 'exact': the reference equals pattern
+                     - 'substring': pattern is contained in the reference
+                     - 'prefix': the reference starts with pattern
+                     - 'glob': shell style pattern, matched component by component,
+                       where ``*`` does not match dots and ``**`` matches any
+                       number of components, e.g. ``top.**.clk*``
+                     - 'regexp': Python regular expression, searched as in :func:`__getitem__`.
+                       Patterns anchored with ``^`` are faster.
+        :type mode: str
+
+        :return: matching references, in definition order
+        :rtype: List[str]
+        """
+        if mode == 'exact':
+            return [pattern] if pattern in self.references_to_ids else []
+        elif mode == 'substring':
+            return [ref for ref in self.signals if pattern in ref]
+        elif mode == 'prefix':
+            return self._names.prefix(pattern)[0]
+        elif mode == 'glob':
+            return self._names.glob(pattern)[0]
+        elif mode == 'regexp':
+            if not isinstance(pattern, _RE_TYPE):
+                pattern = re.compile(pattern)
+            return self._names.regex(pattern)[0]
+        raise ValueError('unknown mode: {}'.format(mode))
+
+    def table(self, refs, pandas=False):
+        """
+        Get the values of several signals aligned in time, with one row per
+        time at which any of the signals changes, and forward-filled values.
+
+        The union of the change times is computed and each column is
+        forward-filled with one vectorized searchsorted, without any per change
+        Python loop. Requires NumPy, and pandas if pandas is True.
+
+        :param refs: references of the signals, or a regular expression that
+                     selects references as in :func:`__getitem__`.
+        :type refs: Union[List[str],str,re.Pattern]
+
+        :param pandas: if True, return a pandas DataFrame indexed by time
+                       instead of a NumPy structured array.
+        :type pandas: bool
+
+        :return: a structured array with an int64 'time' field, and one
+                 object field per reference holding its value at that time,
+                 None before its first change.
+        :rtype: Union[numpy.ndarray,pandas.DataFrame]
+        """
+        import numpy as np
+        if isinstance(refs, _RE_TYPE):
+            refs = self._names.regex(refs)[0]
+        elif isinstance(refs, str):
+            refs = [refs]
+        # Duplicate field names are not allowed.
+        refs = list(dict.fromkeys(refs))
+        signals = [self[ref] for ref in refs]
+        times = [np.frombuffer(signal.times, dtype=np.int64) for signal in signals if signal.times]
+        if times:
+            times = np.unique(np.concatenate(times))
+        else:
+            times = np.empty(0, dtype=np.int64)
+        columns = [signal.sample(times) for signal in signals]
+        if pandas:
+            import pandas as pd
+            return pd.DataFrame(
+                dict(zip(refs, columns)),
+                index=pd.Index(times, name='time'),
+            )
+        out = np.empty(len(times), dtype=[('time', np.int64)] + [(ref, object) for ref in refs])
+        out['time'] = times
+        for ref, column in zip(refs, columns):
+            out[ref] = column
+        return out
+
     def get_data(self):
         """
         Deprecated, use the member variable directly.
@@ -323,6 +798,12 @@ class Signal(object):
 
     Allows for efficient binary search of the value of this signal at a given time.
 
+    Value changes are stored in columnar form: change times go into a typed
+    ``array('q')``, and each value is interned into a per-signal value table
+    and stored as a small integer code in a parallel ``array('I')``.
+    This avoids one tuple plus one string object per value change, which
+    dominates memory usage for large dumps.
+
     :param size: number of bits in the signal
     :type size: int
 
@@ -332,16 +813,428 @@ class Signal(object):
     :ivar references: list of human readable long names for the signal
     :vartype references: List[str]
 
-    :ivar tv: sorted list of time/new value pairs. Signal values are be strings
-              instead of integers to represents values such as 'x'.
-    :vartype tv: List[Tuple[int,str]]
+    :ivar times: sorted times at which the signal changed.
+    :vartype times: array.array
     """
     def __init__(self, size, var_type):
         self.size       = size
         self.var_type   = var_type
         self.references = []
-        self.tv         = []
         self.endtime    = None
+        self.times      = array('q')
+        self._codes     = array('I')
+        self._value_table = []
+        self._value_codes = {}
+        self._positions = None
+        self._positions_count = 0
+        self._pyramid = None
+
+    def append(self, time, value):
+        """
+        Add a value change at the end of the signal.
+
+        Times must be appended in non-decreasing order.
+
+        :type time: int
+        :type value: str
+        """
+        code = self._value_codes.get(value)
+        if code is None:
+            code = self._intern(value)
+        self.times.append(time)
+        self._codes.append(code)
+
+    def _seed_values(self, values):
+        for value in values:
+            if value not in self._value_codes:
+                self._intern(value)
+
+    def _intern(self, value):
+        code = len(self._value_table)
+        self._value_table.append(value)
+        self._value_codes[value] = code
+        return code
+
+    def clear(self):
+        """
+        Remove all stored value changes.
+        """
+        self.times = array('q')
+        self._codes = array('I')
+        self._value_table = []
+        self._value_codes = {}
+        self._positions = None
+        self._positions_count = 0
+        self._pyramid = None
+
+    @property
+    def values(self):
+        """
+        Values of the signal, parallel to :attr:`times`.
+
+        Built on demand from the interned value table.
+
+        :rtype: List[str]
+        """
+        table = self._value_table
+        return [table[code] for code in self._codes]
+
+    @property
+    def tv(self):
+        """
+        Sorted list of time/new value pairs. Signal values are be strings
+        instead of integers to represents values such as 'x'.
+
+        The list is built on demand from :attr:`times` and :attr:`values`,
+        so prefer those for large signals.
+
+        :rtype: List[Tuple[int,str]]
+        """
+        return list(zip(self.times, self.values))
+
+    @tv.setter
+    def tv(self, tv):
+        self.clear()
+        for time, value in tv:
+            self.append(time, value)
+
+    def _value_at_index(self, i):
+        return self._value_table[self._codes[i]]
+
+    def sample(self, times):
+        """
+        Get the values of the signal at many times at once.
+
+        For a range, the cost is one binary search per run of samples that
+        fall between the same two value changes, so it scales with the number
+        of value changes rather than with the number of samples.
+        Other sorted sequences of times are resolved in a single merge-style walk,
+        and NumPy arrays with a single vectorized searchsorted.
+
+        :param times: sorted times at which to sample the signal
+        :type times: Union[range,Iterable[int],numpy.ndarray]
+
+        :return: the value at each time, None before the first value change.
+                 A NumPy object array if times is a NumPy array, a list otherwise.
+        :rtype: Union[List[str],numpy.ndarray]
+        """
+        if isinstance(times, range):
+            return self._sample_range(times)
+        if type(times).__module__ == 'numpy':
+            return self._sample_numpy(times)
+        signal_times = self.times
+        table = self._value_table
+        codes = self._codes
+        n = len(signal_times)
+        out = []
+        i = -1
+        value = None
+        for time in times:
+            if i + 1 < n and signal_times[i + 1] <= time:
+                i = bisect.bisect_right(signal_times, time, i + 1) - 1
+                value = table[codes[i]]
+            out.append(value)
+        return out
+
+    def _sample_range(self, times):
+        if times.step < 0:
+            return self._sample_range(times[::-1])[::-1]
+        signal_times = self.times
+        table = self._value_table
+        codes = self._codes
+        n = len(signal_times)
+        step = times.step
+        remaining = len(times)
+        out = []
+        if not remaining:
+            return out
+        time = times.start
+        i = bisect.bisect_right(signal_times, time) - 1
+        while True:
+            value = None if i < 0 else table[codes[i]]
+            if i + 1 < n:
+                # Number of samples before the next value change.
+                count = min(-((time - signal_times[i + 1]) // step), remaining)
+            else:
+                count = remaining
+            out += [value] * count
+            remaining -= count
+            if not remaining:
+                return out
+            time += count * step
+            i = bisect.bisect_right(signal_times, time, i + 1) - 1
+
+    def _sample_numpy(self, times):
+        import numpy as np
+        out = np.empty(len(times), dtype=object)
+        if not self.times:
+            return out
+        signal_times = np.frombuffer(self.times, dtype=np.int64)
+        i = np.searchsorted(signal_times, times, side='right') - 1
+        valid = i >= 0
+        table = np.empty(len(self._value_table), dtype=object)
+        table[:] = self._value_table
+        out[valid] = table[np.frombuffer(self._codes, dtype=np.uint32)[i[valid]]]
+        return out
+
+    def _value_positions(self):
+        """
+        Sorted indexes of the value changes to each value, by value code.
+
+        Built on first use, and then only extended with the value changes
+        appended since, e.g. by ``VCDVCD(follow=True)``.
+
+        :rtype: List[array.array]
+        """
+        positions = self._positions
+        if positions is None:
+            positions = self._positions = []
+            self._positions_count = 0
+        codes = self._codes
+        start = self._positions_count
+        if start < len(codes):
+            for _ in range(len(self._value_table) - len(positions)):
+                positions.append(array('q'))
+            appends = [p.append for p in positions]
+            for i in range(start, len(codes)):
+                appends[codes[i]](i)
+            self._positions_count = len(codes)
+        return positions
+
+    def _index_range(self, start, end):
+        times = self.times
+        lo = 0 if start is None else bisect.bisect_left(times, start)
+        hi = len(times) if end is None else bisect.bisect_right(times, end)
+        return lo, hi
+
+    def _iter_positions(self, codes, lo, hi):
+        """
+        Iterate in order over the indexes in [lo, hi) of the value changes to any of codes.
+        """
+        positions = self._value_positions()
+        runs = []
+        for code in codes:
+            p = positions[code]
+            i = bisect.bisect_left(p, lo)
+            j = bisect.bisect_left(p, hi)
+            if i < j:
+                runs.append(map(p.__getitem__, range(i, j)))
+        if len(runs) == 1:
+            return runs[0]
+        return heapq.merge(*runs)
+
+    def next_change(self, time):
+        """
+        :return: time and new value of the first value change strictly after time,
+                 or None if there is none.
+        :rtype: Union[NoneType,Tuple[int,str]]
+        """
+        i = bisect.bisect_right(self.times, time)
+        if i == len(self.times):
+            return None
+        return self.times[i], self._value_at_index(i)
+
+    def previous_change(self, time):
+        """
+        :return: time and new value of the last value change strictly before time,
+                 or None if there is none.
+        :rtype: Union[NoneType,Tuple[int,str]]
+        """
+        i = bisect.bisect_left(self.times, time) - 1
+        if i < 0:
+            return None
+        return self.times[i], self._value_at_index(i)
+
+    def find_all(self, value, start=None, end=None):
+        """
+        Iterate over the times at which the signal changes to a given value.
+
+        Each distinct value of the signal is only compared once, and the
+        matching value changes are then read from a per value index, so the
+        cost is proportional to the number of matches rather than to the
+        number of value changes.
+
+        :param value: value to look for, or a function that takes a value
+                      and returns True if it matches, e.g. ``lambda v: 'x' in v``
+        :type value: Union[str,Callable[[str],bool]]
+
+        :param start: only consider value changes at or after this time
+        :type start: int
+
+        :param end: only consider value changes at or before this time
+        :type end: int
+
+        :rtype: Iterator[int]
+        """
+        if callable(value):
+            codes = [code for code, v in enumerate(self._value_table) if value(v)]
+        else:
+            code = self._value_codes.get(value)
+            codes = [] if code is None else [code]
+        times = self.times
+        for i in self._iter_positions(codes, *self._index_range(start, end)):
+            yield times[i]
+
+    def find_first(self, value, start=None, end=None):
+        """
+        Same as :func:`find_all`, but only return the first match.
+
+        :return: the first matching time, or None if there is none.
+        :rtype: Union[NoneType,int]
+        """
+        return next(self.find_all(value, start, end), None)
+
+    # (old, new) lowest bit values that make an edge, as in Verilog posedge and negedge.
+    _RISING_EDGES = frozenset((('0', '1'), ('0', 'x'), ('0', 'z'), ('x', '1'), ('z', '1')))
+    _FALLING_EDGES = frozenset((('1', '0'), ('1', 'x'), ('1', 'z'), ('x', '0'), ('z', '0')))
+
+    def _edges(self, edges, start, end):
+        levels = [_lowest_bit(value) for value in self._value_table]
+        new_levels = set(new for old, new in edges)
+        codes = [code for code, level in enumerate(levels) if level in new_levels]
+        lo, hi = self._index_range(start, end)
+        times = self.times
+        signal_codes = self._codes
+        for i in self._iter_positions(codes, max(lo, 1), hi):
+            if (levels[signal_codes[i - 1]], levels[signal_codes[i]]) in edges:
+                yield times[i]
+
+    def rising_edges(self, start=None, end=None):
+        """
+        Iterate over the times of the rising edges of the signal.
+
+        As for Verilog posedge, these are changes of the lowest bit from 0 to
+        1, x or z, or from x or z to 1. Only changes between two stored value
+        changes are considered, so the first value change is never an edge.
+
+        Only the value changes to 1, x or z are visited, through the same per
+        value index as :func:`find_all`.
+
+        :param start: only consider edges at or after this time
+        :type start: int
+
+        :param end: only consider edges at or before this time
+        :type end: int
+
+        :rtype: Iterator[int]
+        """
+        return self._edges(self._RISING_EDGES, start, end)
+
+    def falling_edges(self, start=None, end=None):
+        """
+        Same as :func:`rising_edges`, but for changes of the lowest bit from
+        1 to 0, x or z, or from x or z to 0, as for Verilog negedge.
+
+        :rtype: Iterator[int]
+        """
+        return self._edges(self._FALLING_EDGES, start, end)
+
+    def summarize(self, start, end, buckets):
+        """
+        Summarize the signal over equal time buckets, e.g. one per pixel
+        of a zoomed out waveform, instead of sampling it at every pixel.
+
+        Each bucket gets the number of value changes inside it, the value in
+        effect at its start and at its end, and the lowest and highest number
+        taken by the signal during it, counting the value in effect at its start.
+        The value in effect at a time is the one of the last value change at that
+        time. When there are more buckets than times, some buckets are empty, and
+        only get the value in effect at their start.
+
+        A pyramid of the minimum and maximum numbers over runs of 2, 4, 8, ...
+        consecutive value changes is built on first use, and kept until the
+        signal gets new value changes. Each bucket then costs a few binary
+        searches and O(log n) pyramid reads, whatever the zoom level, while
+        staying exact for buckets of any width and alignment.
+
+        :param start: start time of the first bucket
+        :type start: int
+
+        :param end: end time of the last bucket, exclusive
+        :type end: int
+
+        :param buckets: number of buckets, each one covering (end - start) / buckets times,
+                        up to rounding
+        :type buckets: int
+
+        :return: (changes, first, last, low, high, unknown) for each bucket.
+                 first and last are values as in :attr:`values`, or None before the first
+                 value change. low and high are numbers as in :func:`to_numpy`, or None
+                 if there is no known value in the bucket. unknown is True if a value
+                 with x or z bits was taken during the bucket.
+        :rtype: List[Tuple[int,str,str,Union[NoneType,int,float],Union[NoneType,int,float],bool]]
+        """
+        times = self.times
+        pyramid = self._pyramid
+        if pyramid is None or pyramid.count != len(times):
+            pyramid = self._pyramid = _SummaryPyramid(self)
+        table = self._value_table
+        codes = self._codes
+        span = end - start
+        out = []
+        i = bisect.bisect_left(times, start)
+        bucket_start = start
+        for bucket in range(buckets):
+            bucket_end = start + span * (bucket + 1) // buckets
+            j = bisect.bisect_left(times, bucket_end, i)
+            # Value change in effect at the bucket start, which also counts,
+            # i.e. the last one of that time.
+            lo = bisect.bisect_right(times, bucket_start, i) - 1
+            # Empty buckets still take the value in effect.
+            stop = max(j, lo + 1)
+            if stop > 0:
+                low, high, unknown = pyramid.range(max(lo, 0), stop)
+                first = None if lo < 0 else table[codes[lo]]
+                last = table[codes[stop - 1]]
+            else:
+                # Before the first value change.
+                low = high = first = last = None
+                unknown = False
+            out.append((j - i, first, last, low, high, unknown))
+            i = j
+            bucket_start = bucket_end
+        return out
+
+    def to_numpy(self):
+        """
+        Export the value changes as NumPy arrays.
+
+        Binary values are converted to integers, and values of real variables to floats.
+        Values that contain any x or z bits are exported as 0, and flagged in the mask.
+        Values that do not fit in 64 bits give an object array of Python ints.
+
+        Each distinct value is only converted once, the arrays are then built
+        with a single vectorized lookup into the value table.
+
+        :return: times, values and x/z mask, all with one entry per value change
+        :rtype: Tuple[numpy.ndarray,numpy.ndarray,numpy.ndarray]
+        """
+        import numpy as np
+        real = self.var_type in _REAL_VAR_TYPES
+        numbers = []
+        mask = []
+        for value in self._value_table:
+            number, masked = _value_to_number(value, real)
+            numbers.append(number)
+            mask.append(masked)
+        if real:
+            dtype = np.float64
+        elif all(-(1 << 63) <= n < (1 << 63) for n in numbers):
+            dtype = np.int64
+        else:
+            dtype = object
+        if not self.times:
+            return (
+                np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=dtype),
+                np.empty(0, dtype=bool),
+            )
+        codes = np.frombuffer(self._codes, dtype=np.uint32)
+        return (
+            np.frombuffer(self.times, dtype=np.int64).copy(),
+            np.array(numbers, dtype=dtype)[codes],
+            np.array(mask, dtype=bool)[codes],
+        )
 
     def __getitem__(self, time):
         """
@@ -352,166 +1245,2224 @@ class Signal(object):
         """
         if isinstance( time, slice ) :
             if not self.endtime:
-                self.endtime = self.tv[-1][0]
+                self.endtime = self.times[-1]
             #Get the start, stop, and step from the slice
-            return [self[ii] for ii in range(*time.indices(self.endtime))]
+            return self.sample(range(*time.indices(self.endtime)))
         elif isinstance( time, int ) :
             if time < 0 : #Handle negative indices
                 time = 0
 
-            left = bisect.bisect_left(self.tv, (time, ''))
-            if left == len(self.tv):
-                i = left - 1
-            else:
-                if self.tv[left][0] == time:
-                    i = left
-                else:
-                    i = left - 1
+            i = bisect.bisect_right(self.times, time) - 1
             if i == -1:
                 return None
-            return self.tv[i][1]
+            return self._value_at_index(i)
         else:
             raise TypeError("Invalid argument type.")
 
-
     def __repr__(self):
-        return pp.pformat(self.__dict__)
+        d = {
+            'endtime': self.endtime,
+            'references': self.references,
+            'size': self.size,
+            'tv': self.tv,
+            'var_type': self.var_type,
+        }
+        return pp.pformat(d)
+
+class _SummaryPyramid(object):
+    """
+    Minimum and maximum numbers of the values of a signal over aligned runs of
+    2 ** k consecutive value changes, for range queries over value changes.
 
-class Scope(MutableMapping):
-    def __init__(self, name, vcd):
-        self.vcd       = vcd
-        self.name      = name
-        self.subElements = {}
+    Level k has one entry per run, and level k + 1 combines pairs of entries
+    of level k. Level 0 is not stored, it is read through the value codes.
+    """
+    def __init__(self, signal):
+        real = signal.var_type in _REAL_VAR_TYPES
+        inf = float('inf')
+        self.low_by_code = []
+        self.high_by_code = []
+        self.unknown_by_code = []
+        for value in signal._value_table:
+            number, masked = _value_to_number(value, real)
+            self.low_by_code.append(inf if masked else number)
+            self.high_by_code.append(-inf if masked else number)
+            self.unknown_by_code.append(masked)
+        self.codes = codes = signal._codes
+        self.count = len(codes)
+        self.lows = []
+        self.highs = []
+        self.unknowns = []
+        lows = list(map(self.low_by_code.__getitem__, codes))
+        highs = list(map(self.high_by_code.__getitem__, codes))
+        unknowns = list(map(self.unknown_by_code.__getitem__, codes))
+        while len(lows) > 1:
+            pairs = len(lows) // 2 * 2
+            tail = pairs < len(lows)
+            # Comprehensions beat map(min, ...), which parses its arguments on each call.
+            next_lows = [a if a < b else b for a, b in zip(lows[0:pairs:2], lows[1::2])]
+            next_highs = [a if a > b else b for a, b in zip(highs[0:pairs:2], highs[1::2])]
+            next_unknowns = list(map(operator.or_, unknowns[0:pairs:2], unknowns[1::2]))
+            if tail:
+                next_lows.append(lows[-1])
+                next_highs.append(highs[-1])
+                next_unknowns.append(unknowns[-1])
+            lows = next_lows
+            highs = next_highs
+            unknowns = next_unknowns
+            self.lows.append(lows)
+            self.highs.append(highs)
+            self.unknowns.append(unknowns)
+
+    def range(self, i, j):
+        """
+        :return: lowest and highest known number, None if none, and True if any value
+                 is unknown, over value changes i to j - 1
+        """
+        codes = self.codes
+        low = float('inf')
+        high = -low
+        unknown = False
+        # Bottom up decomposition of [i, j) into aligned runs.
+        if i & 1:
+            code = codes[i]
+            low = min(low, self.low_by_code[code])
+            high = max(high, self.high_by_code[code])
+            unknown = unknown or self.unknown_by_code[code]
+            i += 1
+        if j & 1:
+            j -= 1
+            code = codes[j]
+            low = min(low, self.low_by_code[code])
+            high = max(high, self.high_by_code[code])
+            unknown = unknown or self.unknown_by_code[code]
+        i >>= 1
+        j >>= 1
+        k = 0
+        while i < j:
+            if i & 1:
+                low = min(low, self.lows[k][i])
+                high = max(high, self.highs[k][i])
+                unknown = unknown or self.unknowns[k][i]
+                i += 1
+            if j & 1:
+                j -= 1
+                low = min(low, self.lows[k][j])
+                high = max(high, self.highs[k][j])
+                unknown = unknown or self.unknowns[k][j]
+            i >>= 1
+            j >>= 1
+            k += 1
+        if low > high:
+            low = high = None
+        return low, high, bool(unknown)
+
+class FourStateValue(object):
+    """
+    Value of a vector with possible x and z bits, packed into two integers
+    as in the Verilog VPI aval/bval encoding:
 
-    def __len__(self):
-        return self.subElements.__len__()
+    ====  ====  =====
+    bit   bits  xz
+    ====  ====  =====
+    0     0     0
+    1     1     0
+    z     0     1
+    x     1     1
+    ====  ====  =====
 
-    def __setitem__(self, k, v) :
-        return self.subElements.__setitem__(k, v)
+    Values without x or z bits, the common case, compare and hash equal to
+    the int of their bits, so e.g. ``value == 5`` works.
 
-    def __getitem__(self, k) :
-        if isinstance(k, _RE_TYPE):
-            pattern = '^'+re.escape(self.name)+'\.'+k.pattern
-            return self.vcd[re.compile(pattern)]
-        if k in self.subElements:
-            element = self.subElements.__getitem__(k)
-            if isinstance(element, Scope):
-                return element
+    :ivar size: number of bits
+    :vartype size: int
 
-            return self.vcd[element]
+    :ivar bits: value bits, with bit 0 the rightmost bit of the VCD value
+    :vartype bits: int
 
-    def __delitem__(self, v) :
-        return self.subElements.__delitem__(v)
+    :ivar xz: mask of the bits that are x or z
+    :vartype xz: int
+    """
+    __slots__ = ('size', 'bits', 'xz')
 
-    def __iter__(self):
-        return self.subElements.__iter__()
+    def __init__(self, size, bits, xz=0):
+        self.size = size
+        self.bits = bits
+        self.xz = xz
 
-    def __contains__(self, o: object) -> bool:
-        return self.subElements.__contains__(o)
+    @classmethod
+    def from_string(cls, value, size=None):
+        """
+        :param value: binary value as found in VCDs, e.g. '10x1'. As in VCDs,
+                      shorter values are extended to size with 0, or with their
+                      leftmost bit if it is x or z.
+        :type value: str
 
-    def __repr__(self):
-        return self.name +'\n{\n\t' +'\n\t'.join(self.subElements)+'\n}'
+        :param size: number of bits, defaults to the length of value.
+        :type size: int
 
-class StreamParserCallbacks(object):
-    def enddefinitions(
-        self,
-        vcd,
-        signals,
-        cur_sig_vals
-    ):
-        """
-        Called at $enddefinitions, i.e. once after the wire metadata finishes parsing at the
-        at the start start of parsing.
+        :rtype: FourStateValue
         """
-        pass
+        if size is None:
+            size = len(value)
+        bits, xz = _pack_value(value, size)
+        return cls(size, bits, xz)
 
-    def time(
-        self,
-        vcd,
-        time,
-        cur_sig_vals
-    ):
+    @property
+    def known(self):
         """
-        Called whenever a new time is found.
+        True if the value has no x or z bits.
+
+        :rtype: bool
         """
-        pass
+        return not self.xz
 
-    def value(
-        self,
-        vcd,
-        time,
-        value,
-        identifier_code,
-        cur_sig_vals,
-    ):
+    def __int__(self):
+        if self.xz:
+            raise ValueError('value has x or z bits: {}'.format(self))
+        return self.bits
+
+    __index__ = __int__
+
+    def hex(self):
         """
-        Called whenever the value of a signal changes.
+        Format as hexadecimal, as :func:`binary_string_to_hex`: if there are
+        any x or z bits, only the leftmost one is returned.
+
+        :rtype: str
         """
+        if self.xz:
+            top = self.xz.bit_length() - 1
+            return 'x' if self.bits >> top & 1 else 'z'
+        return format(self.bits, 'x')
+
+    def __str__(self):
+        if not self.xz:
+            return format(self.bits, '0{}b'.format(self.size))
+        return ''.join(
+            '01zx'[(self.bits >> i & 1) | (self.xz >> i & 1) << 1]
+            for i in range(self.size - 1, -1, -1)
+        )
+
+    def __repr__(self):
+        return 'FourStateValue.from_string({!r})'.format(str(self))
+
+    def __eq__(self, other):
+        if isinstance(other, FourStateValue):
+            return self.bits == other.bits and self.xz == other.xz
+        if isinstance(other, int) and not isinstance(other, bool):
+            return not self.xz and self.bits == other
+        return NotImplemented
+
+    def __hash__(self):
+        if not self.xz:
+            return hash(self.bits)
+        return hash((self.bits, self.xz))
+
+# str.translate tables from VCD bit characters to the bits and xz planes.
+_BITS_TABLE = str.maketrans('xXzZ', '1100')
+_XZ_TABLE = str.maketrans('01xXzZ', '001111')
+
+def _pack_value(value, size):
+    """
+    Convert a VCD binary value to its :class:`FourStateValue` bits and xz integers.
+
+    Characters other than 0, 1, x and z are taken as x.
+
+    :rtype: Tuple[int,int]
+    """
+    mask = (1 << size) - 1
+    try:
+        return int(value, 2) & mask, 0
+    except ValueError:
         pass
+    if len(value) < size and value[:1] in ('x', 'X', 'z', 'Z'):
+        value = value[0] * (size - len(value)) + value
+    try:
+        bits = int(value.translate(_BITS_TABLE), 2)
+        xz = int(value.translate(_XZ_TABLE), 2)
+    except ValueError:
+        bits = xz = 0
+        for c in value:
+            bits = bits << 1 | (c not in '0zZ')
+            xz = xz << 1 | (c not in '01')
+    return bits & mask, xz & mask
+
+def _lowest_bit(value):
+    """
+    :return: '0', '1', 'x' or 'z' for the rightmost bit of a value,
+             or '' if it is not binary.
+    """
+    if isinstance(value, FourStateValue):
+        return '01zx'[(value.bits & 1) | (value.xz & 1) << 1]
+    return value[-1:].lower()
 
-class PrintDeltasStreamParserCallbacks(StreamParserCallbacks):
+class _PackedValues(object):
     """
-    https://github.com/cirosantilli/vcdvcd#vcdcat-deltas
+    Value table of a :class:`PackedSignal`.
+
+    The bits of all values are stored back to back in one bytearray, with a
+    fixed number of bytes per value, and the xz masks only for the values
+    that have any x or z bits.
+
+    Values are interned on their packed bits, like the strings of :class:`Signal`,
+    until there are more than :attr:`INTERN_LIMIT` distinct ones. The signal is
+    then taken to have mostly distinct values, e.g. a wide data bus, for which
+    the index would cost more than it saves, and later values are just appended.
     """
-    def value(
-        self,
-        vcd,
-        time,
-        value,
-        identifier_code,
-        cur_sig_vals,
-    ):
-        print('{} {} {}'.format(
-            time,
-            binary_string_to_hex(value),
-            vcd.data[identifier_code].references[0])
-        )
 
-class PrintDumpsStreamParserCallbacks(StreamParserCallbacks):
-    def __init__(self, deltas=True):
-        """
-        Print the values of all signals whenever a new signal entry
-        of any signal is parsed.
+    INTERN_LIMIT = 1024
 
-        :param deltas:
-            - if True, print only if a value in the selected signals since the
-                previous time If no values changed, don't print anything.
+    def __init__(self, size):
+        self.size = size
+        self.nbytes = max((size + 7) // 8, 1)
+        self.bits = bytearray()
+        self.xz = {}
+        # Index of each distinct value, by xz << size | bits, None once over INTERN_LIMIT.
+        self.index = {}
 
-                This is the same format as shown at:
-                https://github.com/cirosantilli/vcdvcd#vcdcat-deltas
-                without --deltas.
+    def __len__(self):
+        return len(self.bits) // self.nbytes
 
-            - if False, print all values at all times
-        :type deltas: bool
+    def intern(self, value):
         """
-        self._deltas = deltas
-        self._references_to_widths = {}
+        :type value: Union[str,FourStateValue]
+        :return: index of the value, which is appended if new
+        :rtype: int
+        """
+        if isinstance(value, FourStateValue):
+            mask = (1 << self.size) - 1
+            bits, xz = value.bits & mask, value.xz & mask
+        else:
+            bits, xz = _pack_value(value, self.size)
+        index = self.index
+        if index is not None:
+            key = xz << self.size | bits
+            i = index.get(key)
+            if i is not None:
+                return i
+        i = len(self.bits) // self.nbytes
+        self.bits += bits.to_bytes(self.nbytes, 'little')
+        if xz:
+            self.xz[i] = xz
+        if index is not None:
+            if len(index) < self.INTERN_LIMIT:
+                index[key] = i
+            else:
+                self.index = None
+        return i
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        start = i * self.nbytes
+        if i < 0 or start >= len(self.bits):
+            raise IndexError(i)
+        return FourStateValue(
+            self.size,
+            int.from_bytes(self.bits[start:start + self.nbytes], 'little'),
+            self.xz.get(i, 0),
+        )
 
-    def enddefinitions(
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class PackedSignal(Signal):
+    """
+    A :class:`Signal` created by ``VCDVCD(packed=True)`` for vectors, whose
+    values are :class:`FourStateValue` instead of strings.
+
+    Values are stored packed at one bit per bit plus the x and z bits of the
+    values that have any, see :class:`_PackedValues`, which is much smaller
+    than one string per distinct value for wide buses, whose values rarely repeat.
+
+    :func:`find_all` and edge searches scan the value changes in the given
+    range instead of using a per value index.
+    """
+    def __init__(self, size, var_type):
+        Signal.__init__(self, size, var_type)
+        self._value_table = _PackedValues(int(size))
+
+    def _seed_values(self, values):
+        pass
+
+    def _intern(self, value):
+        # _value_codes stays empty, values are interned by the table on their packed bits.
+        return self._value_table.intern(value)
+
+    def clear(self):
+        Signal.clear(self)
+        self._value_table = _PackedValues(int(self.size))
+
+    def find_all(self, value, start=None, end=None):
+        """
+        Same as :meth:`Signal.find_all`. value can also be an int, a
+        :class:`FourStateValue`, or a binary string that gets packed.
+        """
+        if callable(value):
+            match = value
+        else:
+            if isinstance(value, str):
+                value = FourStateValue.from_string(value, int(self.size))
+            match = lambda v: v == value
+        table = self._value_table
+        times = self.times
+        codes = self._codes
+        for i in range(*self._index_range(start, end)):
+            if match(table[codes[i]]):
+                yield times[i]
+
+    def _edges(self, edges, start, end):
+        table = self._value_table
+        times = self.times
+        codes = self._codes
+        lo, hi = self._index_range(start, end)
+        lo = max(lo, 1)
+        if lo >= hi:
+            return
+        level = _lowest_bit(table[codes[lo - 1]])
+        for i in range(lo, hi):
+            new_level = _lowest_bit(table[codes[i]])
+            if (level, new_level) in edges:
+                yield times[i]
+            level = new_level
+
+# Magic bytes at the start of the supported compressed file formats.
+_COMPRESSION_MAGICS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+def _detect_compression(vcd_path):
+    """
+    :return: the name of the compression format of the file, or None if not compressed.
+    :rtype: Union[NoneType,str]
+    """
+    with open(vcd_path, 'rb') as vcd_file:
+        start = vcd_file.read(6)
+    for magic, compression in _COMPRESSION_MAGICS:
+        if start.startswith(magic):
+            return compression
+    return None
+
+def _open_vcd(vcd_path, use_mmap=False):
+    """
+    Open a VCD file for parsing.
+
+    Compressed files are decompressed on the fly while being read.
+
+    :return: a binary file object, or a read-only mmap if use_mmap is True
+             and the file is not compressed. Both support read, readline,
+             seek and tell, and can be used as context managers.
+    """
+    compression = _detect_compression(vcd_path)
+    if compression == 'gzip':
+        return gzip.open(vcd_path, 'rb')
+    elif compression == 'bz2':
+        return bz2.open(vcd_path, 'rb')
+    elif compression == 'xz':
+        return lzma.open(vcd_path, 'rb')
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstandard is required to read zstd compressed VCD files: python -m pip install zstandard')
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(vcd_path, 'rb'), closefd=True),
+            buffer_size=StreamParser.BLOCK_SIZE
+        )
+    vcd_file = open(vcd_path, 'rb')
+    if use_mmap:
+        try:
+            mapped = mmap.mmap(vcd_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            return vcd_file
+        vcd_file.close()
+        return mapped
+    return vcd_file
+
+# Chunks of the value changes section parsed by each task of VCDVCD(processes=).
+_PARALLEL_MIN_CHUNK_BYTES = 4 << 20
+
+# Interned first by every chunk, so that the value codes of most single bit
+# signals can be merged without remapping.
+_PARALLEL_SEED_VALUES = ('0', '1', 'x', 'z')
+
+def _find_time_line(vcd_file, pos, size):
+    """
+    :return: offset of the first #time line starting at or after pos, or None.
+    """
+    if pos >= size:
+        return None
+    base = pos - 1
+    vcd_file.seek(base)
+    prev = b''
+    while True:
+        block = vcd_file.read(StreamParser.BLOCK_SIZE)
+        if not block:
+            return None
+        buf = prev + block
+        i = buf.find(b'\n#')
+        if i != -1:
+            return base + i + 1
+        base += len(buf) - 1
+        prev = buf[-1:]
+
+def _parse_chunk(args):
+    """
+    Worker of ``VCDVCD(processes=)``: parse the value changes between two
+    byte offsets of a VCD file.
+
+    :return: begintime and endtime of the chunk, or None if it has no #time,
+             the final signal_changed, for every signal that changed,
+             the time and value code arrays as bytes, the value table and
+             the last value, and if stats is True, the number of lines and
+             the number of value changes of each signal.
+    """
+    vcd_path, start, end, identifier_codes, time, store_tvs, use_mmap, stats = args
+    parser = StreamParser(stats=ParseStats() if stats else None)
+    vcd = parser.vcd
+    for identifier_code in identifier_codes:
+        signal = Signal(None, None)
+        signal._seed_values(_PARALLEL_SEED_VALUES)
+        vcd.data[identifier_code] = signal
+    parser.in_header = False
+    parser.time = time
+    with _open_vcd(vcd_path, use_mmap) as vcd_file:
+        vcd_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            n = parser.feed_file(vcd_file, min(remaining, StreamParser.BLOCK_SIZE))
+            if not n:
+                break
+            remaining -= n
+        parser.close()
+    chunk_data = {}
+    for identifier_code, signal in vcd.data.items():
+        if signal.times:
+            last_value = signal._value_at_index(-1)
+            if store_tvs:
+                chunk_data[identifier_code] = (
+                    signal.times.tobytes(),
+                    signal._codes.tobytes(),
+                    signal._value_table,
+                    last_value,
+                )
+            else:
+                chunk_data[identifier_code] = (b'', b'', [], last_value)
+    if stats:
+        chunk_stats = (
+            parser.stats.lines,
+            {identifier_code: len(signal.times) for identifier_code, signal in vcd.data.items() if signal.times},
+        )
+    else:
+        chunk_stats = None
+    if parser._first_time:
+        return None, None, False, chunk_data, chunk_stats
+    return vcd.begintime, vcd.endtime, vcd.signal_changed, chunk_data, chunk_stats
+
+class LazySignal(Signal):
+    """
+    A :class:`Signal` created by ``VCDVCD(lazy=True)``, whose value changes
+    are only parsed from the VCD file when first needed.
+
+    Looking up the value at a single time with ``signal[time]`` before the
+    signal is loaded only parses the part of the file between the closest
+    preceding checkpoint of the index and that time.
+
+    Accessing anything else that needs the value changes, e.g. :attr:`times`,
+    :attr:`tv` or slicing, loads all value changes of the signal once.
+    """
+    _LAZY_ATTRS = frozenset((
+        'times', '_codes', '_value_table', '_value_codes', '_positions', '_positions_count', '_pyramid'))
+
+    def __init__(self, size, var_type, index, identifier_code):
+        self.size       = size
+        self.var_type   = var_type
+        self.references = []
+        self.endtime    = None
+        self._index = index
+        self._identifier_code = identifier_code
+
+    @property
+    def loaded(self):
+        """
+        True if the value changes of this signal have already been parsed.
+
+        :rtype: bool
+        """
+        return 'times' in self.__dict__
+
+    def load(self):
+        """
+        Parse all value changes of this signal from the VCD file.
+        """
+        endtime = self.endtime
+        self.clear()
+        self._index.scan(self, self._identifier_code)
+        self.endtime = endtime
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set, i.e. before loading.
+        if name in LazySignal._LAZY_ATTRS:
+            self.load()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, time):
+        if isinstance(time, int) and not self.loaded:
+            return self._index.value_at(self._identifier_code, max(time, 0))
+        return Signal.__getitem__(self, time)
+
+class _LazyIndex(object):
+    """
+    Sparse index of the value changes section of a VCD file.
+
+    Checkpoint k holds a byte offset at which parsing can be resumed, the time
+    in effect at that offset, and the values of the signals that changed between
+    checkpoints k - 1 and k.
+    """
+
+    # Approximate distance between checkpoints.
+    CHECKPOINT_BYTES = 16 << 20
+
+    def __init__(self, vcd_path, use_mmap=False):
+        self.vcd_path = vcd_path
+        self.use_mmap = use_mmap
+        # Kept open across scans when use_mmap.
+        self._mmap = None
+        self.offsets = []
+        self.times = []
+        self.deltas = []
+
+    def add(self, offset, time, deltas):
+        self.offsets.append(offset)
+        self.times.append(time)
+        self.deltas.append(deltas)
+
+    def scan(self, signal, identifier_code, k=0, end_time=None):
+        """
+        Store the value changes of a single signal into the given signal,
+        starting from checkpoint k, and stopping some time after end_time.
+        """
+        parser = StreamParser()
+        parser.vcd.data[identifier_code] = signal
+        parser.time = self.times[k]
+        if self.use_mmap:
+            if self._mmap is None:
+                self._mmap = _open_vcd(self.vcd_path, True)
+            vcd_file = self._mmap
+        else:
+            vcd_file = open(self.vcd_path, 'rb')
+        try:
+            vcd_file.seek(self.offsets[k])
+            while parser.feed_file(vcd_file, StreamParser.BLOCK_SIZE):
+                if end_time is not None and parser.time > end_time:
+                    # The incomplete last line is not the end of the file, e.g. a bare #.
+                    parser._tail = b''
+                    break
+            parser.close()
+        finally:
+            if vcd_file is not self._mmap:
+                vcd_file.close()
+
+    def value_at(self, identifier_code, time):
+        k = max(bisect.bisect_right(self.times, time) - 1, 0)
+        signal = Signal(None, None)
+        self.scan(signal, identifier_code, k, end_time=time)
+        value = signal[time]
+        while value is None and k >= 0:
+            value = self.deltas[k].get(identifier_code)
+            k -= 1
+        return value
+
+class _SpillStore(object):
+    """
+    Temporary file that holds the value changes moved out of memory by
+    ``VCDVCD(memory_budget=...)``.
+
+    While parsing, whenever the times and value codes held in memory exceed
+    the budget, those of the signals with the most value changes are appended
+    to the file as segments, and the signals start again from empty arrays.
+    Once parsing is over, :func:`finish` copies the segments of each signal,
+    followed by what is still in memory, contiguously into a second file, which
+    is then memory mapped read-only. The times and codes of the spilled signals
+    become memoryviews into that mapping, which support everything that
+    :class:`Signal` does with its arrays other than appending, and whose pages
+    are backed by the file rather than by RAM.
+    """
+
+    # Bytes of memory per stored value change: one time and one value code.
+    CHANGE_BYTES = 12
+
+    # Bytes copied at a time by finish.
+    COPY_BYTES = 1 << 20
+
+    def __init__(self, memory_budget, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self._file = None
+        # (times offset, codes offset, number of changes) of the spilled segments, by identifier code.
+        self.segments = {}
+        # Bytes written to the file so far.
+        self.bytes = 0
+        # Upper bound of the value changes in memory.
+        self.changes = 0
+
+    def check(self, data, changes):
+        """
+        Spill signals until the value changes in memory are back to half
+        the budget, if they exceed it.
+
+        The value changes are only counted exactly, in O(signals), once the
+        running upper bound goes over the budget. Signals are then spilled
+        from three quarters of the budget on, so that exact counts stay rare
+        even when the bound is loose, e.g. with many unselected signals.
+
+        :param changes: number of value changes stored since the last call,
+                        or an upper bound of it such as the number of tokens parsed
+        :type changes: int
+        """
+        budget = self.memory_budget // self.CHANGE_BYTES
+        self.changes += changes
+        if self.changes <= budget:
+            return
+        total = sum(len(signal.times) for signal in data.values())
+        self.changes = total
+        if total <= budget * 3 // 4:
+            return
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.spill_dir)
+        f = self._file
+        for identifier_code, signal in sorted(data.items(), key=lambda item: -len(item[1].times)):
+            if total <= budget // 2:
+                break
+            times = signal.times
+            n = len(times)
+            times_offset = self.bytes
+            times.tofile(f)
+            codes_offset = times_offset + n * times.itemsize
+            signal._codes.tofile(f)
+            self.bytes = codes_offset + n * signal._codes.itemsize
+            self.segments.setdefault(identifier_code, []).append((times_offset, codes_offset, n))
+            signal.times = array('q')
+            signal._codes = array('I')
+            total -= n
+        self.changes = total
+
+    def _copy(self, out, offset, nbytes):
+        f = self._file
+        f.seek(offset)
+        while nbytes:
+            chunk = f.read(min(nbytes, self.COPY_BYTES))
+            out.write(chunk)
+            nbytes -= len(chunk)
+
+    def finish(self, data):
+        """
+        Move all value changes of the spilled signals to a read-only mapping.
+        """
+        if self._file is None:
+            return
+        out = tempfile.TemporaryFile(dir=self.spill_dir)
+        layout = []
+        position = 0
+        for identifier_code, segments in self.segments.items():
+            signal = data[identifier_code]
+            n = sum(segment[2] for segment in segments) + len(signal.times)
+            times_offset = position
+            for segment_offset, _, count in segments:
+                self._copy(out, segment_offset, count * 8)
+            signal.times.tofile(out)
+            codes_offset = times_offset + n * 8
+            for _, segment_offset, count in segments:
+                self._copy(out, segment_offset, count * 4)
+            signal._codes.tofile(out)
+            position = codes_offset + n * 4
+            # Keep the next times aligned.
+            padding = -position % 8
+            out.write(b'\0' * padding)
+            position += padding
+            layout.append((signal, times_offset, codes_offset, n))
+        self._file.close()
+        self._file = None
+        out.flush()
+        try:
+            mapping = mmap.mmap(out.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # The mapping stays valid after the file is closed and deleted.
+            out.close()
+        view = memoryview(mapping)
+        for signal, times_offset, codes_offset, n in layout:
+            signal.times = view[times_offset:times_offset + n * 8].cast('q')
+            signal._codes = view[codes_offset:codes_offset + n * 4].cast('I')
+        self.segments = {}
+
+def _regex_has_toplevel_branch(pattern):
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+        elif in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+            # A ] right after [ or [^ is a literal.
+            if pattern[i + 1:i + 2] == '^':
+                i += 1
+            if pattern[i + 1:i + 2] == ']':
+                i += 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+def _regex_literal_prefix(regex):
+    """
+    Literal string that all matches of a regular expression start with, or
+    the empty string if it cannot be told by a simple look at the pattern.
+
+    Only patterns anchored with ``^`` or ``\\A``, without alternations or
+    flags that change literal matching, give a non empty prefix.
+    """
+    pattern = regex.pattern
+    if (
+        not isinstance(pattern, str) or
+        regex.flags & (re.IGNORECASE | re.VERBOSE) or
+        _regex_has_toplevel_branch(pattern)
+    ):
+        return ''
+    if pattern.startswith('^'):
+        i = 1
+    elif pattern.startswith('\\A'):
+        i = 2
+    else:
+        return ''
+    prefix = []
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            c = pattern[i + 1:i + 2]
+            if not c or c.isalnum():
+                break
+            n = 2
+        elif c in '.^$*+?{}[]()':
+            break
+        else:
+            n = 1
+        quantifier = pattern[i + n:i + n + 1]
+        if quantifier and quantifier in '*?{':
+            break
+        prefix.append(c)
+        if quantifier == '+':
+            break
+        i += n
+    return ''.join(prefix)
+
+class _NameNode(object):
+    __slots__ = ('children', 'signal', 'scope')
+
+    def __init__(self):
+        self.children = {}
+        # (definition order, reference) if a signal has exactly this name.
+        self.signal = None
+        # (definition order, name) if a scope has exactly this name.
+        self.scope = None
+
+class _NameIndex(object):
+    """
+    Trie over the dot separated components of the signal and scope names,
+    filled as $var and $scope are parsed.
+
+    Prefix, glob and anchored regular expression queries only visit the
+    subtrees that can match, instead of testing every name. Results are in
+    definition order, as in :attr:`VCDVCD.signals`.
+    """
+    def __init__(self):
+        self.root = _NameNode()
+        self.nsignals = 0
+        self.nscopes = 0
+        # In definition order, for the queries that the trie can't prune.
+        self.signals = []
+        self.scopes = []
+
+    def _add(self, name):
+        node = self.root
+        for component in name.split('.'):
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _NameNode()
+            node = child
+        return node
+
+    def add_signal(self, reference):
+        self._add(reference).signal = (self.nsignals, reference)
+        self.nsignals += 1
+        self.signals.append(reference)
+
+    def add_scope(self, name):
+        self._add(name).scope = (self.nscopes, name)
+        self.nscopes += 1
+        self.scopes.append(name)
+
+    @staticmethod
+    def _names(nodes, subtrees):
+        signals = []
+        scopes = []
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if node.signal is not None:
+                signals.append(node.signal)
+            if node.scope is not None:
+                scopes.append(node.scope)
+            if subtrees:
+                stack.extend(node.children.values())
+        signals.sort()
+        scopes.sort()
+        return [name for _, name in signals], [name for _, name in scopes]
+
+    def _prefix_nodes(self, prefix):
+        """
+        Roots of the subtrees that contain all the names starting with prefix.
+        """
+        components = prefix.split('.')
+        node = self.root
+        for component in components[:-1]:
+            node = node.children.get(component)
+            if node is None:
+                return []
+        last = components[-1]
+        return [child for name, child in node.children.items() if name.startswith(last)]
+
+    def prefix(self, prefix):
+        """
+        :return: (signals, scopes) whose names start with prefix.
+        :rtype: Tuple[List[str],List[str]]
+        """
+        return self._names(self._prefix_nodes(prefix), True)
+
+    def glob(self, pattern):
+        """
+        Match names with a shell style pattern, where each dot separated
+        component is matched with :func:`fnmatch.fnmatchcase`, and a ``**``
+        component matches any number of components. ``*`` does not match dots.
+
+        :return: (signals, scopes) that match pattern.
+        :rtype: Tuple[List[str],List[str]]
+        """
+        components = pattern.split('.')
+        matches = {}
+        stack = [(self.root, 0)]
+        seen = set()
+        while stack:
+            node, i = stack.pop()
+            if (id(node), i) in seen:
+                continue
+            seen.add((id(node), i))
+            if i == len(components):
+                matches[id(node)] = node
+                continue
+            component = components[i]
+            if component == '**':
+                stack.append((node, i + 1))
+                stack.extend((child, i) for child in node.children.values())
+            elif any(c in component for c in '*?['):
+                stack.extend(
+                    (child, i + 1)
+                    for name, child in node.children.items()
+                    if fnmatch.fnmatchcase(name, component)
+                )
+            else:
+                child = node.children.get(component)
+                if child is not None:
+                    stack.append((child, i + 1))
+        return self._names(matches.values(), False)
+
+    def regex(self, regex):
+        """
+        Names for which regex.search matches. Only the subtrees below the
+        literal prefix of anchored patterns are tested. Other patterns are
+        tested against all names in a plain scan, which is cheaper than
+        walking and sorting the whole trie.
+
+        :return: (signals, scopes) that match regex.
+        :rtype: Tuple[List[str],List[str]]
+        """
+        prefix = _regex_literal_prefix(regex)
+        if prefix:
+            signals, scopes = self.prefix(prefix)
+        else:
+            signals, scopes = self.signals, self.scopes
+        search = regex.search
+        return (
+            [name for name in signals if search(name)],
+            [name for name in scopes if search(name)],
+        )
+
+class Scope(MutableMapping):
+    def __init__(self, name, vcd):
+        self.vcd       = vcd
+        self.name      = name
+        self.subElements = {}
+
+    def __len__(self):
+        return self.subElements.__len__()
+
+    def __setitem__(self, k, v) :
+        return self.subElements.__setitem__(k, v)
+
+    def __getitem__(self, k) :
+        if isinstance(k, _RE_TYPE):
+            pattern = '^' + re.escape(self.name) + r'\.(?:' + k.pattern + ')'
+            return self.vcd[re.compile(pattern, k.flags)]
+        if k in self.subElements:
+            element = self.subElements.__getitem__(k)
+            if isinstance(element, Scope):
+                return element
+
+            return self.vcd[element]
+
+    def __delitem__(self, v) :
+        return self.subElements.__delitem__(v)
+
+    def __iter__(self):
+        return self.subElements.__iter__()
+
+    def __contains__(self, o: object) -> bool:
+        return self.subElements.__contains__(o)
+
+    def __repr__(self):
+        return self.name +'\n{\n\t' +'\n\t'.join(self.subElements)+'\n}'
+
+class StreamParserCallbacks(object):
+    def enddefinitions(
+        self,
+        vcd,
+        signals,
+        cur_sig_vals
+    ):
+        """
+        Called at $enddefinitions, i.e. once after the wire metadata finishes parsing at the
+        at the start start of parsing.
+        """
+        pass
+
+    def time(
+        self,
+        vcd,
+        time,
+        cur_sig_vals
+    ):
+        """
+        Called whenever a new time is found.
+        """
+        pass
+
+    def value(
+        self,
+        vcd,
+        time,
+        value,
+        identifier_code,
+        cur_sig_vals,
+    ):
+        """
+        Called whenever the value of a signal changes.
+        """
+        pass
+
+    def end(self, vcd):
+        """
+        Called once after the last time callback, when parsing is over.
+        """
+        pass
+
+class _TimedCallbacks(object):
+    """
+    Forward to the callbacks of a parser created with stats, adding the time
+    spent in them to the stats, and counting value changes per signal if
+    they are not stored.
+    """
+    def __init__(self, callbacks, stats, value, time, count_values):
+        self._callbacks = callbacks
+        self._stats = stats
+        self._value = value
+        self._time = time
+        self._count_values = count_values
+
+    def enddefinitions(self, vcd, signals, cur_sig_vals):
+        start = perf_counter()
+        self._callbacks.enddefinitions(vcd, signals, cur_sig_vals)
+        self._stats.callback_seconds += perf_counter() - start
+
+    def time(self, vcd, time, cur_sig_vals):
+        start = perf_counter()
+        if self._time is not None:
+            self._time(vcd, time, cur_sig_vals)
+        else:
+            self._callbacks.time(vcd, time, cur_sig_vals)
+        self._stats.callback_seconds += perf_counter() - start
+
+    def value(self, vcd, time, value, identifier_code, cur_sig_vals):
+        stats = self._stats
+        if self._count_values:
+            counts = stats.signal_changes
+            counts[identifier_code] = counts.get(identifier_code, 0) + 1
+        if self._value is not None:
+            start = perf_counter()
+            self._value(
+                vcd,
+                time=time,
+                value=value,
+                identifier_code=identifier_code,
+                cur_sig_vals=cur_sig_vals
+            )
+            stats.callback_seconds += perf_counter() - start
+
+    def end(self, vcd):
+        start = perf_counter()
+        self._callbacks.end(vcd)
+        self._stats.callback_seconds += perf_counter() - start
+
+class ParseStats(object):
+    """
+    Statistics of a parse, filled by ``VCDVCD(stats=True)``.
+
+    :ivar bytes: number of bytes parsed, decompressed for compressed files
+    :vartype bytes: int
+
+    :ivar lines: number of lines parsed
+    :vartype lines: int
+
+    :ivar header_seconds: time spent parsing the header, up to $enddefinitions
+    :vartype header_seconds: float
+
+    :ivar total_seconds: total parse time
+    :vartype total_seconds: float
+
+    :ivar callback_seconds: time spent inside the callbacks
+    :vartype callback_seconds: float
+
+    :ivar events: number of value changes of the selected signals
+    :vartype events: int
+
+    :ivar signal_changes: number of value changes of each selected signal, by identifier code
+    :vartype signal_changes: Dict[str,int]
+
+    :ivar store_bytes: approximate memory used by the stored value changes,
+                       which is also the peak, since the store only grows while parsing
+    :vartype store_bytes: int
+    """
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+        self.header_seconds = 0.0
+        self.total_seconds = 0.0
+        self.callback_seconds = 0.0
+        self.events = 0
+        self.signal_changes = {}
+        self.store_bytes = 0
+        self._start = None
+        self._references = {}
+
+    @property
+    def body_seconds(self):
+        """
+        Time spent parsing the value changes after the header.
+
+        :rtype: float
+        """
+        return self.total_seconds - self.header_seconds
+
+    @property
+    def events_per_second(self):
+        """
+        :rtype: float
+        """
+        if not self.total_seconds:
+            return 0.0
+        return self.events / self.total_seconds
+
+    @property
+    def bytes_per_second(self):
+        """
+        :rtype: float
+        """
+        if not self.total_seconds:
+            return 0.0
+        return self.bytes / self.total_seconds
+
+    def most_active(self, n=10):
+        """
+        :return: the n signals with the most value changes, as (reference, number of changes)
+                 pairs sorted by decreasing number of changes.
+        :rtype: List[Tuple[str,int]]
+        """
+        counts = sorted(self.signal_changes.items(), key=lambda item: -item[1])[:n]
+        return [(self._references.get(i, i), count) for i, count in counts]
+
+    def _collect(self, vcd, store_tvs):
+        """
+        Compute the totals from the parsed VCD at the end of a parse.
+        """
+        if store_tvs:
+            self.signal_changes = {
+                identifier_code: len(signal.times)
+                for identifier_code, signal in vcd.data.items()
+            }
+            self.store_bytes = sum(_store_bytes(signal) for signal in vcd.data.values())
+        self.events = sum(self.signal_changes.values())
+        self._references = {
+            identifier_code: signal.references[0]
+            for identifier_code, signal in vcd.data.items()
+            if signal.references
+        }
+
+    def __str__(self):
+        lines = [
+            'bytes: {}'.format(self.bytes),
+            'lines: {}'.format(self.lines),
+            'events: {}'.format(self.events),
+            'total_seconds: {:.6f}'.format(self.total_seconds),
+            'header_seconds: {:.6f}'.format(self.header_seconds),
+            'body_seconds: {:.6f}'.format(self.body_seconds),
+            'callback_seconds: {:.6f}'.format(self.callback_seconds),
+            'bytes_per_second: {:.0f}'.format(self.bytes_per_second),
+            'events_per_second: {:.0f}'.format(self.events_per_second),
+            'store_bytes: {}'.format(self.store_bytes),
+            'most_active:',
+        ]
+        for reference, count in self.most_active():
+            lines.append('  {} {}'.format(count, reference))
+        return '\n'.join(lines)
+
+class ActivityStats(object):
+    """
+    Activity of the signals of a VCD, e.g. for power estimation or as a coverage
+    sanity check, gathered in a single streaming pass that does not store any
+    value changes, so memory is proportional to the number of signals.
+
+    For each signal, the following are counted:
+
+    - changes: value changes to a different value. Repeated dumps of the same value are ignored.
+    - toggles: bits that went from 0 to 1 or from 1 to 0, over all value changes
+    - time_0, time_1, time_x: time spent at 0, at 1 and at x or z.
+      For vectors, at 0 means all bits at 0, at x means any bit at x or z,
+      and at 1 means any other known value. Signals are at x until their
+      first value change, and time is counted up to the last time read.
+    - duty_cycle: fraction of that time spent at 1, None if no time passed.
+
+    Real and other non bit vector variables only get their changes counted.
+
+    The changes and toggles are also summed for each scope over all the signals below it,
+    where a signal that has references in several places of a scope only counts once.
+
+    :param vcd_path: path of the VCD, possibly compressed
+    :type vcd_path: str
+
+    :param vcd_string: use this string as the VCD content instead of vcd_path
+    :type vcd_string: str
+
+    :param signals: only consider these references, all if None
+    :type signals: List[str]
+
+    :param start_time: only count activity from this time on, see :class:`VCDVCD`
+    :type start_time: int
+
+    :param end_time: stop reading the file after this time, see :class:`VCDVCD`
+    :type end_time: int
+
+    :ivar vcd: header of the VCD
+    :vartype vcd: VCDVCD
+
+    :ivar signals: activity of each reference, as a dict with the keys described above.
+                   References to the same signal share the same dict.
+    :vartype signals: Dict[str,Dict[str,Any]]
+
+    :ivar scopes: dict with the number of ``signals``, ``changes`` and ``toggles`` of each scope
+    :vartype scopes: Dict[str,Dict[str,int]]
+    """
+    def __init__(
+        self,
+        vcd_path=None,
+        vcd_string=None,
+        signals=None,
+        start_time=None,
+        end_time=None,
+    ):
+        parser = StreamParser(
+            store_tvs=False,
+            store_scopes=True,
+            signals=signals,
+            start_time=start_time,
+            end_time=end_time,
+        )
+        self.vcd = vcd = parser.vcd
+        self._start_time = start_time
+        self._identifier_codes = None
+        if vcd_string is not None:
+            vcd_file = io.BytesIO(vcd_string.encode('utf-8'))
+        else:
+            vcd_file = vcd_path
+        for events in parser.iter_changes(vcd_file):
+            if self._identifier_codes is None:
+                self._start()
+            self._add(events)
+        if self._identifier_codes is None:
+            self._start()
+        self._finish(vcd.endtime)
+
+    def _start(self):
+        """
+        Set up the per signal counters, once the header is parsed.
+        """
+        vcd = self.vcd
+        self._identifier_codes = list(vcd.data)
+        self._index = {identifier_code: i for i, identifier_code in enumerate(self._identifier_codes)}
+        n = len(self._identifier_codes)
+        begin = vcd.begintime if self._start_time is None else self._start_time
+        self._bits = [
+            vcd.data[identifier_code].var_type not in _UNPACKED_VAR_TYPES
+            for identifier_code in self._identifier_codes
+        ]
+        self._sizes = [
+            int(vcd.data[identifier_code].size) if bits else None
+            for identifier_code, bits in zip(self._identifier_codes, self._bits)
+        ]
+        self._last = [None] * n
+        self._state = [2] * n
+        self._since = [begin] * n
+        self._changes = [0] * n
+        self._toggles = [0] * n
+        # Time at 0, 1 and x, indexed by state.
+        self._state_times = ([0] * n, [0] * n, [0] * n)
+        # New state and number of toggles of each (old, new) pair of short values.
+        self._cache = {}
+
+    def _add(self, events):
+        index = self._index
+        last = self._last
+        bits = self._bits
+        sizes = self._sizes
+        states = self._state
+        since = self._since
+        changes = self._changes
+        toggles = self._toggles
+        state_times = self._state_times
+        cache = self._cache
+        for time, identifier_code, value in events:
+            i = index[identifier_code]
+            old = last[i]
+            if value == old:
+                continue
+            last[i] = value
+            changes[i] += 1
+            if not bits[i]:
+                continue
+            key = (old, value)
+            transition = cache.get(key)
+            if transition is None:
+                transition = (
+                    _activity_state(value),
+                    0 if old is None else _bit_toggles(old, value, sizes[i]),
+                )
+                if len(value) <= _FORMAT_CACHE_MAX_BITS:
+                    cache[key] = transition
+            state_times[states[i]][i] += time - since[i]
+            states[i], count = transition
+            since[i] = time
+            toggles[i] += count
+
+    def _finish(self, end):
+        vcd = self.vcd
+        self.signals = {}
+        self.scopes = {}
+        time_0, time_1, time_x = self._state_times
+        for i, identifier_code in enumerate(self._identifier_codes):
+            if self._bits[i]:
+                self._state_times[self._state[i]][i] += max(end - self._since[i], 0)
+            total = time_0[i] + time_1[i] + time_x[i]
+            activity = {
+                'changes': self._changes[i],
+                'toggles': self._toggles[i],
+                'time_0': time_0[i],
+                'time_1': time_1[i],
+                'time_x': time_x[i],
+                'duty_cycle': time_1[i] / total if total else None,
+            }
+            scopes = set()
+            for reference in vcd.data[identifier_code].references:
+                self.signals[reference] = activity
+                for k, c in enumerate(reference):
+                    if c == '.' and reference[:k] in vcd.scopes:
+                        scopes.add(reference[:k])
+            for scope in scopes:
+                totals = self.scopes.get(scope)
+                if totals is None:
+                    totals = self.scopes[scope] = {'signals': 0, 'changes': 0, 'toggles': 0}
+                totals['signals'] += 1
+                totals['changes'] += activity['changes']
+                totals['toggles'] += activity['toggles']
+
+    def hottest(self, n=None, key='toggles'):
+        """
+        :return: the n signals with the highest key, all if n is None, as
+                 (reference, activity) pairs sorted by decreasing key, with
+                 only the first reference of each signal. Signals whose key is
+                 None, e.g. the duty_cycle of reals, come last.
+        :rtype: List[Tuple[str,Dict[str,Any]]]
+        """
+        references = (self.vcd.data[identifier_code].references[0] for identifier_code in self._identifier_codes)
+        items = [(reference, self.signals[reference]) for reference in references]
+        def sort_key(item):
+            value = item[1][key]
+            return (value is None, 0 if value is None else -value)
+        items.sort(key=sort_key)
+        return items[:n]
+
+def _activity_state(value):
+    """
+    :return: 0 if all bits of value are 0, 2 if any is x or z, 1 otherwise
+    """
+    if 'x' in value or 'z' in value or 'X' in value or 'Z' in value:
+        return 2
+    if '1' in value:
+        return 1
+    return 0
+
+def _bit_toggles(old, new, size):
+    """
+    Number of bits that go from 0 to 1 or from 1 to 0 between two values.
+    """
+    try:
+        return bin(int(old, 2) ^ int(new, 2)).count('1')
+    except ValueError:
+        pass
+    old = _extend_value(old, size)
+    new = _extend_value(new, size)
+    return sum(1 for a, b in zip(old, new) if a != b and a in '01' and b in '01')
+
+def _store_bytes(signal):
+    """
+    Approximate memory used by the value changes of a signal.
+    """
+    table = signal._value_table
+    if isinstance(table, _PackedValues):
+        table_bytes = sys.getsizeof(table.bits) + sys.getsizeof(table.xz)
+        if table.index is not None:
+            table_bytes += sys.getsizeof(table.index) + sum(sys.getsizeof(key) for key in table.index)
+    else:
+        table_bytes = (
+            sys.getsizeof(table) +
+            sys.getsizeof(signal._value_codes) +
+            sum(sys.getsizeof(value) for value in table)
+        )
+    return sys.getsizeof(signal.times) + sys.getsizeof(signal._codes) + table_bytes
+
+# Token kinds, dispatched on the first character of each whitespace separated token.
+_SCALAR_TOKEN = 0
+_TIME_TOKEN = 1
+_VECTOR_TOKEN = 2
+_COMMAND_TOKEN = 3
+_TOKEN_KINDS = {}
+for c in VCDVCD._VALUE:
+    _TOKEN_KINDS[c] = _SCALAR_TOKEN
+for c in VCDVCD._VECTOR_VALUE_CHANGE:
+    _TOKEN_KINDS[c] = _VECTOR_TOKEN
+_TOKEN_KINDS['#'] = _TIME_TOKEN
+_TOKEN_KINDS['$'] = _COMMAND_TOKEN
+del c
+
+# Keywords whose body is made of regular value changes, so they can be skipped.
+_DUMP_KEYWORDS = set(('$dumpvars', '$dumpall', '$dumpon', '$dumpoff', '$end'))
+
+# Variable types whose values are floats.
+_REAL_VAR_TYPES = frozenset(('real', 'realtime'))
+
+# Variable types whose values are not binary, and are never packed.
+_UNPACKED_VAR_TYPES = _REAL_VAR_TYPES | frozenset(('string', 'event'))
+
+class StreamParser(object):
+    """
+    The parsing engine behind :class:`VCDVCD`.
+
+    Consumes a VCD file as large blocks of bytes. Each block is cut at its
+    last newline, decoded and split into whitespace separated tokens in bulk,
+    and every token is then dispatched on its first character through a table.
+    Anything after the last newline is kept and prepended to the next block.
+
+    Header commands such as ``$var`` or ``$scope`` are gathered up to their
+    ``$end`` even if split across blocks, and then update the header model of
+    the given :class:`VCDVCD` object.
+
+    Besides callbacks, the value changes can also be pulled from the parser
+    with the :func:`iter_changes` and :func:`iter_times` generators.
+
+    :param vcd: object whose data, signals, hierarchy and related members get filled.
+                If None, a new empty one is created.
+    :type vcd: VCDVCD
+
+    :param stats: statistics to fill while parsing
+    :type stats: ParseStats
+
+    :param total_bytes: size of the input, passed on to progress
+    :type total_bytes: int
+
+    :param memory_budget: see :class:`VCDVCD`. The budget is checked after each block.
+    :type memory_budget: int
+
+    Other parameters are the same as for :class:`VCDVCD`.
+    """
+
+    BLOCK_SIZE = 1 << 20
+    # Smaller blocks for iter_changes, so that the event lists stay in cache.
+    ITER_BLOCK_SIZE = 1 << 14
+
+    def __init__(
+        self,
+        vcd=None,
+        only_sigs=False,
+        signals=None,
+        store_tvs=True,
+        store_scopes=False,
+        callbacks=None,
+        start_time=None,
+        end_time=None,
+        packed=False,
+        stats=None,
+        progress=None,
+        total_bytes=None,
+        memory_budget=None,
+        spill_dir=None,
+    ):
+        if vcd is None:
+            vcd = VCDVCD.__new__(VCDVCD)
+            vcd._reset()
+        if signals is None:
+            signals = []
+        if callbacks is None:
+            callbacks = StreamParserCallbacks()
+        self.vcd = vcd
+        self.only_sigs = only_sigs
+        self.signals = signals
+        self.store_tvs = store_tvs
+        self.store_scopes = store_scopes
+        self.callbacks = callbacks
+        self.start_time = start_time
+        self.end_time = end_time
+        self.packed = packed
+        self.stats = stats
+        self.progress = progress
+        self.total_bytes = total_bytes
+        # Bytes fed so far, only counted if instrumented.
+        self.bytes_done = 0
+        self._instrumented = stats is not None or progress is not None
+        if memory_budget is not None and store_tvs:
+            self._spill = _SpillStore(memory_budget, spill_dir)
+        else:
+            self._spill = None
+        self.cur_sig_vals = {}
+        self.hier = []
+        self.time = 0
+        self.done = False
+        self._before_window = start_time is not None and start_time > self.time
+        # Last values of the signals that changed before start_time.
+        self._window_values = {}
+        # (time, identifier_code, value) of the value changes of the current block, when iterating.
+        self._events = None
+        self._all_sigs = not signals
+        self._signals_set = set(signals)
+        self._scopes_stack = [vcd.hierarchy]
+        self._first_time = True
+        self.in_header = True
+        self._tail = b''
+        # Command whose $end was not reached yet at the end of the last block.
+        self._command = None
+        # Vector value whose identifier was not reached yet at the end of the last block.
+        self._vector_value = None
+        # Skip the per change and per time method calls if not overridden.
+        if type(callbacks).value is StreamParserCallbacks.value:
+            self._value_callback = None
+        else:
+            self._value_callback = callbacks.value
+        if type(callbacks).time is StreamParserCallbacks.time:
+            self._time_callback = None
+        else:
+            self._time_callback = callbacks.time
+        if stats is not None:
+            stats._start = perf_counter()
+            timed = self.callbacks = _TimedCallbacks(
+                callbacks,
+                stats,
+                self._value_callback,
+                self._time_callback,
+                count_values=not store_tvs,
+            )
+            if self._value_callback is not None or not store_tvs:
+                self._value_callback = timed.value
+            if self._time_callback is not None:
+                self._time_callback = timed.time
+
+    def parse(self, vcd_file, block_size=None):
+        """
+        Parse an entire binary file object, and call :func:`close`.
+
+        :param vcd_file: file opened in binary mode
+        :param block_size: number of bytes read at a time
+        :type block_size: int
+        """
+        if block_size is None:
+            block_size = self.BLOCK_SIZE
+        while not self.done:
+            if not self.feed_file(vcd_file, block_size):
+                break
+        self.close()
+
+    def iter_changes(self, vcd_file, batch_size=None):
+        """
+        Parse a VCD file, and yield its value changes as they are parsed.
+
+        This is a pull based alternative to :class:`StreamParserCallbacks`,
+        which collects the changes of each block into a list instead of making
+        one method call per change. The file is only read as the generator is
+        consumed, so stopping the iteration also stops reading the file.
+        Callbacks and storage given to the constructor still apply.
+
+        :param vcd_file: path of the VCD, or binary file object or mmap to read from
+        :type vcd_file: Union[str,BinaryIO,mmap.mmap]
+
+        :param batch_size: if given, yield lists of exactly this many changes,
+                           except for the last one. Otherwise, yield all the
+                           changes of each parsed block at once.
+        :type batch_size: int
+
+        :return: generator of lists of (time, identifier_code, value) tuples,
+                 identifier codes can be looked up in ``self.vcd.data``.
+        :rtype: Iterator[List[Tuple[int,str,str]]]
+        """
+        if isinstance(vcd_file, str):
+            vcd_file = _open_vcd(vcd_file)
+            owned = True
+        else:
+            owned = False
+        try:
+            events = self._events = []
+            while not self.done:
+                if not self.feed_file(vcd_file, self.ITER_BLOCK_SIZE):
+                    break
+                if batch_size is None:
+                    if events:
+                        yield events
+                        events = self._events = []
+                elif len(events) >= batch_size:
+                    end = len(events) - len(events) % batch_size
+                    for i in range(0, end, batch_size):
+                        yield events[i:i + batch_size]
+                    events = self._events = events[end:]
+            self.close()
+            if batch_size is None:
+                if events:
+                    yield events
+            else:
+                # close may have parsed many more changes from the last line.
+                for i in range(0, len(events), batch_size):
+                    yield events[i:i + batch_size]
+        finally:
+            self._events = None
+            if owned:
+                vcd_file.close()
+
+    def iter_times(self, vcd_file):
+        """
+        Same as :func:`iter_changes`, but group changes by time step.
+
+        Time steps without any changes of the selected signals are skipped.
+
+        :return: generator of (time, changes) where changes is a list of
+                 (identifier_code, value) tuples in file order.
+        :rtype: Iterator[Tuple[int,List[Tuple[str,str]]]]
+        """
+        cur_time = None
+        changes = []
+        for events in self.iter_changes(vcd_file):
+            for time, identifier_code, value in events:
+                if time != cur_time:
+                    if changes:
+                        yield cur_time, changes
+                        changes = []
+                    cur_time = time
+                changes.append((identifier_code, value))
+        if changes:
+            yield cur_time, changes
+
+    def feed_file(self, vcd_file, size):
+        """
+        Parse up to size bytes from the current position of a binary file object or mmap.
+
+        mmaps are parsed in place with :func:`feed_buffer`.
+
+        :return: number of bytes consumed, 0 at the end of the file.
+        :rtype: int
+        """
+        if isinstance(vcd_file, mmap.mmap):
+            start = vcd_file.tell()
+            end = min(start + size, len(vcd_file))
+            self.feed_buffer(vcd_file, start, end)
+            vcd_file.seek(end)
+            return end - start
+        block = vcd_file.read(size)
+        self.feed(block)
+        return len(block)
+
+    def feed_buffer(self, buf, start=0, end=None):
+        """
+        Same as :func:`feed` for a range of a large buffer such as an mmap.
+
+        The buffer is decoded one block at a time straight from memory,
+        without first copying each block into a bytes object.
+
+        :type buf: Union[bytes,mmap.mmap]
+        :return: True if parsing is over, e.g. because of only_sigs.
+        :rtype: bool
+        """
+        if end is None:
+            end = len(buf)
+        block_size = self.BLOCK_SIZE
+        with memoryview(buf) as view:
+            if self._instrumented and not self.done:
+                if self.stats is not None:
+                    # mmaps have no count.
+                    lines = bytes(view[start:end]).count(b'\n')
+                else:
+                    lines = None
+                self._account(end - start, lines)
+            pos = start
+            while pos < end and not self.done:
+                stop = min(pos + block_size, end)
+                if self._tail:
+                    # Only copy what completes the pending line, and parse the rest in place.
+                    newline = buf.find(b'\n', pos, stop)
+                    if newline == -1:
+                        self._tail += bytes(view[pos:stop])
+                        pos = stop
+                    else:
+                        self._feed(bytes(view[pos:newline + 1]))
+                        pos = newline + 1
+                    continue
+                newline = buf.rfind(b'\n', pos, stop)
+                if newline == -1:
+                    self._tail = bytes(view[pos:stop])
+                    pos = stop
+                    continue
+                tokens = str(view[pos:newline + 1], 'utf-8', 'replace').split()
+                self._parse_tokens(tokens)
+                if self._spill is not None:
+                    # Each stored value change takes at least one token.
+                    self._spill.check(self.vcd.data, len(tokens))
+                pos = newline + 1
+                if stop == end and pos < end:
+                    self._tail = bytes(view[pos:end])
+                    pos = end
+        return self.done
+
+    def feed(self, data):
+        """
+        Parse the next chunk of bytes of the VCD.
+
+        Incomplete lines are kept until the next call.
+
+        :type data: bytes
+        :return: True if parsing is over, e.g. because of only_sigs.
+        :rtype: bool
+        """
+        if self._instrumented and not self.done:
+            self._account(len(data), data.count(b'\n') if self.stats is not None else None)
+        return self._feed(data)
+
+    def _feed(self, data):
+        if self.done:
+            return True
+        if self._tail:
+            data = self._tail + data
+        end = data.rfind(b'\n') + 1
+        self._tail = data[end:]
+        if end:
+            tokens = str(memoryview(data)[:end], 'utf-8', 'replace').split()
+            self._parse_tokens(tokens)
+            if self._spill is not None:
+                # Each stored value change takes at least one token.
+                self._spill.check(self.vcd.data, len(tokens))
+        return self.done
+
+    def _account(self, nbytes, lines):
+        self.bytes_done += nbytes
+        stats = self.stats
+        if stats is not None:
+            stats.bytes += nbytes
+            if lines is not None:
+                stats.lines += lines
+        if self.progress is not None:
+            self.progress(self.bytes_done, self.total_bytes)
+
+    def close(self):
+        """
+        Parse any remaining incomplete last line and finish parsing.
+        """
+        if self._tail and not self.done:
+            tail = self._tail
+            self._tail = b''
+            self._parse_tokens(tail.decode('utf-8', 'replace').split())
+        if self._before_window and not self.in_header:
+            # The file ended before start_time, so the window is empty, and
+            # endtime stays the last time of the file.
+            self._before_window = False
+            self.cur_sig_vals.update(self._window_values)
+            self._window_values.clear()
+        self.done = True
+        vcd = self.vcd
+        self.callbacks.time(vcd, self.time, self.cur_sig_vals)
+        self.callbacks.end(vcd)
+        if self._spill is not None:
+            self._spill.finish(vcd.data)
+        for aSignal in vcd.data.values():
+            aSignal.endtime = vcd.endtime
+
+    def _parse_tokens(self, tokens):
+        vcd = self.vcd
+        data_get = vcd.data.get
+        cur_sig_vals = self.cur_sig_vals
+        value_callback = self._value_callback
+        time_callback = self._time_callback
+        store_tvs = self.store_tvs
+        events = self._events
+        if events is not None:
+            events_append = events.append
+        kinds_get = _TOKEN_KINDS.get
+        time = self.time
+        it = iter(tokens)
+
+        if self._command is not None:
+            keyword, args = self._command
+            self._command = None
+            if not self._collect_command(it, keyword, args):
+                return
+            time = self.time
+        if self._vector_value is not None:
+            value = self._vector_value
+            self._vector_value = None
+            identifier_code = next(it, None)
+            if identifier_code is None:
+                self._vector_value = value
+                return
+            self._value(time, value, identifier_code)
+        if self._before_window:
+            if not self._parse_tokens_before_window(it):
+                return
+            time = self.time
+
+        end_time = self.end_time
+        for token in it:
+            kind = kinds_get(token[0])
+            if kind == _SCALAR_TOKEN or kind == _VECTOR_TOKEN:
+                if kind == _SCALAR_TOKEN:
+                    value = token[0]
+                    identifier_code = token[1:]
+                else:
+                    value = token[1:]
+                    identifier_code = next(it, None)
+                    if identifier_code is None:
+                        self._vector_value = value
+                        break
+                # May not be there due to signal selection.
+                entry = data_get(identifier_code)
+                if entry is not None:
+                    if events is not None:
+                        events_append((time, identifier_code, value))
+                    if value_callback is not None:
+                        value_callback(
+                            vcd,
+                            time=time,
+                            value=value,
+                            identifier_code=identifier_code,
+                            cur_sig_vals=cur_sig_vals
+                        )
+                    vcd.signal_changed = True
+                    if store_tvs:
+                        # Inlined Signal.append, this is the hottest path.
+                        code = entry._value_codes.get(value)
+                        if code is None:
+                            code = entry._intern(value)
+                        entry.times.append(time)
+                        entry._codes.append(code)
+                    cur_sig_vals[identifier_code] = value
+            elif kind == _TIME_TOKEN:
+                new_time = int(token[1:])
+                if end_time is not None and new_time > end_time:
+                    self.done = True
+                    break
+                if time_callback is not None:
+                    time_callback(vcd, time, cur_sig_vals)
+                time = new_time
+                if self._first_time:
+                    vcd.begintime = time
+                    self._first_time = False
+                vcd.endtime = time
+                vcd.signal_changed = False
+            elif kind == _COMMAND_TOKEN:
+                if token in _DUMP_KEYWORDS:
+                    continue
+                self.time = time
+                if not self._collect_command(it, token, []):
+                    return
+        self.time = time
+
+    def _parse_tokens_before_window(self, it):
+        """
+        Only track the last value of each signal, until the first time >= start_time.
+
+        :return: True if the window was reached and parsing is not over.
+        """
+        vcd = self.vcd
+        data = vcd.data
+        values = self._window_values
+        kinds_get = _TOKEN_KINDS.get
+        for token in it:
+            kind = kinds_get(token[0])
+            if kind == _SCALAR_TOKEN:
+                identifier_code = token[1:]
+                if identifier_code in data:
+                    values[identifier_code] = token[0]
+            elif kind == _VECTOR_TOKEN:
+                identifier_code = next(it, None)
+                if identifier_code is None:
+                    self._vector_value = token[1:]
+                    return False
+                if identifier_code in data:
+                    values[identifier_code] = token[1:]
+            elif kind == _TIME_TOKEN:
+                time = int(token[1:])
+                if self._first_time:
+                    vcd.begintime = time
+                    self._first_time = False
+                if time >= self.start_time:
+                    self._enter_window(time)
+                    return not self.done
+                vcd.endtime = time
+                self.time = time
+            elif kind == _COMMAND_TOKEN:
+                if token in _DUMP_KEYWORDS:
+                    continue
+                if not self._collect_command(it, token, []):
+                    return False
+        return False
+
+    def _enter_window(self, time):
+        vcd = self.vcd
+        values = self._window_values
+        self._before_window = False
+        self.cur_sig_vals.update(values)
+        if self.store_tvs:
+            for identifier_code, value in values.items():
+                vcd.data[identifier_code].append(self.start_time, value)
+            if self._spill is not None:
+                self._spill.changes += len(values)
+        if self._events is not None:
+            for identifier_code, value in values.items():
+                self._events.append((self.start_time, identifier_code, value))
+        # The values in effect at start_time count as changes of the first time step.
+        vcd.signal_changed = bool(values)
+        values.clear()
+        if self.end_time is not None and time > self.end_time:
+            # Only start_time is in the window, the last time callback reports it.
+            vcd.endtime = self.start_time
+            self.time = self.start_time
+            self.done = True
+            return
+        if time > self.start_time:
+            # start_time is not in the file, report it as a time step of its own.
+            if self._time_callback is not None:
+                self._time_callback(vcd, self.start_time, self.cur_sig_vals)
+            vcd.signal_changed = False
+        vcd.endtime = time
+        self.time = time
+
+    def _value(self, time, value, identifier_code):
+        vcd = self.vcd
+        entry = vcd.data.get(identifier_code)
+        if entry is not None and self._before_window:
+            self._window_values[identifier_code] = value
+        elif entry is not None:
+            if self._events is not None:
+                self._events.append((time, identifier_code, value))
+            if self._value_callback is not None:
+                self._value_callback(
+                    vcd,
+                    time=time,
+                    value=value,
+                    identifier_code=identifier_code,
+                    cur_sig_vals=self.cur_sig_vals
+                )
+            vcd.signal_changed = True
+            if self.store_tvs:
+                entry.append(time, value)
+            self.cur_sig_vals[identifier_code] = value
+
+    def _collect_command(self, it, keyword, args):
+        """
+        Gather the arguments of a command up to its $end and handle it.
+
+        :return: False if the tokens ran out before $end, or if parsing is over.
+        """
+        for token in it:
+            if token == '$end':
+                break
+            args.append(token)
+        else:
+            self._command = (keyword, args)
+            return False
+        self._handle_command(keyword, args)
+        return not self.done
+
+    def _handle_command(self, keyword, args):
+        vcd = self.vcd
+        if keyword == '$enddefinitions':
+            self.in_header = False
+            if self.stats is not None:
+                self.stats.header_seconds = perf_counter() - self.stats._start
+            if self.only_sigs:
+                self.done = True
+                return
+            self.callbacks.enddefinitions(vcd, self.signals, self.cur_sig_vals)
+        elif keyword == '$scope':
+            scope_name = args[1]
+            hier = self.hier
+            hier.append(scope_name)
+            if self.store_scopes:
+                full_scope_name              = '.'.join(hier)
+                new_scope                    = Scope(full_scope_name, vcd)
+                self._scopes_stack[-1][scope_name] = new_scope
+                vcd.scopes[full_scope_name]  = new_scope
+                vcd._names.add_scope(full_scope_name)
+                self._scopes_stack.append(new_scope)
+        elif keyword == '$upscope':
+            self.hier.pop()
+            if self.store_scopes:
+                self._scopes_stack.pop()
+        elif keyword == '$var':
+            type = args[0]
+            size = args[1]
+            identifier_code = args[2]
+            name = ''.join(args[3:])
+            path = '.'.join(self.hier)
+            if path:
+                reference = path + '.' + name
+            else:
+                reference = name
+            if self.store_scopes:
+                self._scopes_stack[-1][name] = reference
+            if (reference in self._signals_set) or self._all_sigs:
+                vcd.signals.append(reference)
+                vcd._names.add_signal(reference)
+                if identifier_code not in vcd.data:
+                    if self.packed and type not in _UNPACKED_VAR_TYPES and size != '1':
+                        vcd.data[identifier_code] = PackedSignal(size, type)
+                    else:
+                        vcd.data[identifier_code] = Signal(size, type)
+                vcd.data[identifier_code].references.append(reference)
+                vcd.references_to_ids[reference] = identifier_code
+                self.cur_sig_vals[identifier_code] = 'x'
+        elif keyword == '$timescale':
+            timescale = ' '.join(args)
+            magnitude = Decimal(re.findall(r"\d+|$", timescale)[0])
+            if magnitude not in [1, 10, 100]:
+                print("Error: Magnitude of timescale must be one of 1, 10, or 100. "\
+                    + "Current magnitude is: {}".format(magnitude))
+                exit(-1)
+            unit      = re.findall(r"s|ms|us|ns|ps|fs|$", timescale)[0]
+            factor = {
+                "s":  '1e0',
+                "ms": '1e-3',
+                "us": '1e-6',
+                "ns": '1e-9',
+                "ps": '1e-12',
+                "fs": '1e-15',
+            }[unit]
+            vcd.timescale["timescale"] = magnitude * Decimal(factor)
+            vcd.timescale["magnitude"] = magnitude
+            vcd.timescale["unit"]   = unit
+            vcd.timescale["factor"] = Decimal(factor)
+
+class _BufferedWriter(object):
+    """
+    Gather output lines, and write them to a file in large chunks instead of
+    with one print call per line.
+    """
+    LINES = 4096
+
+    def __init__(self, file=None):
+        self._file = file
+        self._lines = []
+
+    def append(self, line):
+        lines = self._lines
+        lines.append(line)
+        if len(lines) >= self.LINES:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            # Resolved at write time, so that redirections of sys.stdout apply.
+            file = sys.stdout if self._file is None else self._file
+            self._lines.append('')
+            file.write('\n'.join(self._lines))
+            self._lines = []
+
+# Values with at most this many bits get their formatted output cached,
+# as they can only take a small number of distinct values.
+_FORMAT_CACHE_MAX_BITS = 8
+
+class PrintDeltasStreamParserCallbacks(StreamParserCallbacks):
+    """
+    https://github.com/cirosantilli/vcdvcd#vcdcat-deltas
+
+    Output is buffered, and written in large chunks.
+
+    :param file: where to write, defaults to sys.stdout
+    :type file: TextIO
+    """
+    def __init__(self, file=None):
+        self._out = _BufferedWriter(file)
+        self._refs = {}
+        self._hex = {}
+        self._time = None
+        self._time_prefix = None
+
+    def value(
+        self,
+        vcd,
+        time,
+        value,
+        identifier_code,
+        cur_sig_vals,
+    ):
+        if time != self._time:
+            self._time = time
+            self._time_prefix = '{} '.format(time)
+        ref = self._refs.get(identifier_code)
+        if ref is None:
+            ref = self._refs[identifier_code] = ' ' + vcd.data[identifier_code].references[0]
+        value_hex = self._hex.get(value)
+        if value_hex is None:
+            value_hex = binary_string_to_hex(value)
+            if len(value) <= _FORMAT_CACHE_MAX_BITS:
+                self._hex[value] = value_hex
+        self._out.append(self._time_prefix + value_hex + ref)
+
+    def end(self, vcd):
+        self._out.flush()
+
+class PrintDumpsStreamParserCallbacks(StreamParserCallbacks):
+    def __init__(self, deltas=True, file=None):
+        """
+        Print the values of all signals whenever a new signal entry
+        of any signal is parsed.
+
+        The formatted value of each column is cached, and only formatted again
+        when that signal changes, and output is buffered and written in large chunks.
+
+        :param deltas:
+            - if True, print only if a value in the selected signals since the
+                previous time If no values changed, don't print anything.
+
+                This is the same format as shown at:
+                https://github.com/cirosantilli/vcdvcd#vcdcat-deltas
+                without --deltas.
+
+            - if False, print all values at all times
+        :type deltas: bool
+
+        :param file: where to write, defaults to sys.stdout
+        :type file: TextIO
+        """
+        self._deltas = deltas
+        self._references_to_widths = {}
+        self._out = _BufferedWriter(file)
+
+    def enddefinitions(
         self,
         vcd,
         signals,
         cur_sig_vals
     ):
-        print('0 time')
+        out = self._out
+        out.append('0 time')
         if signals:
             self._print_dumps_refs = signals
         else:
             self._print_dumps_refs = sorted(vcd.data[i].references[0] for i in cur_sig_vals.keys())
         for i, ref in enumerate(self._print_dumps_refs, 1):
-            print('{} {}'.format(i, ref))
-            if i == 0:
-                i = 1
+            out.append('{} {}'.format(i, ref))
             identifier_code = vcd.references_to_ids[ref]
             size = int(vcd.data[identifier_code].size)
             width = max(((size // 4)), int(math.floor(math.log10(i))) + 1)
             self._references_to_widths[ref] = width
-        print()
-        print('0 '.format(i, ), end='')
-        for i, ref in enumerate(self._print_dumps_refs, 1):
-            print('{0:>{1}d} '.format(i, self._references_to_widths[ref]), end='')
-        print()
-        print('=' * (sum(self._references_to_widths.values()) + len(self._references_to_widths) + 1))
+        out.append('')
+        out.append('0 ' + ''.join(
+            '{0:>{1}d} '.format(i, self._references_to_widths[ref])
+            for i, ref in enumerate(self._print_dumps_refs, 1)
+        ))
+        out.append('=' * (sum(self._references_to_widths.values()) + len(self._references_to_widths) + 1))
+        # Columns of each signal, with the formatted value of each column,
+        # and per column width caches of formatted values.
+        self._columns = {}
+        self._widths = []
+        self._caches = {}
+        for column, ref in enumerate(self._print_dumps_refs):
+            identifier_code = vcd.references_to_ids[ref]
+            width = self._references_to_widths[ref]
+            self._columns.setdefault(identifier_code, []).append(column)
+            self._widths.append(width)
+            self._caches.setdefault(width, {})
+        # Formatted from cur_sig_vals at the first time, which also takes
+        # the values set without value callbacks by start_time into account.
+        self._cells = None
+        self._row = None
+
+    def _format(self, value, width):
+        cache = self._caches[width]
+        cell = cache.get(value)
+        if cell is None:
+            cell = binary_string_to_hex(value).rjust(width)
+            if len(value) <= _FORMAT_CACHE_MAX_BITS:
+                cache[value] = cell
+        return cell
+
+    def value(
+        self,
+        vcd,
+        time,
+        value,
+        identifier_code,
+        cur_sig_vals,
+    ):
+        columns = self._columns.get(identifier_code)
+        if columns is not None and self._cells is not None:
+            for column in columns:
+                self._cells[column] = self._format(value, self._widths[column])
+            self._row = None
 
     def time(
         self,
@@ -519,17 +3470,473 @@ class PrintDumpsStreamParserCallbacks(StreamParserCallbacks):
         time,
         cur_sig_vals
     ):
+        if self._cells is None:
+            self._cells = [None] * len(self._widths)
+            for identifier_code, columns in self._columns.items():
+                for column in columns:
+                    self._cells[column] = self._format(cur_sig_vals[identifier_code], self._widths[column])
         if (not self._deltas or vcd.signal_changed):
-            ss = []
-            ss.append('{}'.format(time))
-            for i, ref in enumerate(self._print_dumps_refs):
-                identifier_code = vcd.references_to_ids[ref]
-                value = cur_sig_vals[identifier_code]
-                ss.append('{0:>{1}s}'.format(
-                    binary_string_to_hex(value),
-                    self._references_to_widths[ref])
-                )
-            print(' '.join(ss))
+            row = self._row
+            if row is None:
+                row = self._row = ' '.join(self._cells)
+            self._out.append('{} {}'.format(time, row))
+
+    def end(self, vcd):
+        self._out.flush()
+
+class WriteVCDStreamParserCallbacks(StreamParserCallbacks):
+    """
+    Write the selected signals back out as a VCD, e.g. to extract a few
+    signals over a time window of a huge dump in a single streaming pass
+    with ``store_tvs=False``.
+
+    The header has the timescale, and the scopes and variables of the selected
+    signals, taken from the hierarchy if store_scopes was given, and from the
+    dotted reference names otherwise. Scopes are all written as modules.
+    If start_time is given, a ``$dumpvars`` with the values of all selected
+    signals at start_time comes first, so that the extract starts from the
+    correct state. Output is buffered, and written in large chunks.
+
+    :param file: where to write, defaults to sys.stdout
+    :type file: TextIO
+
+    :param start_time: the start_time given to the parser, if any
+    :type start_time: int
+    """
+    def __init__(self, file=None, start_time=None):
+        self._out = _BufferedWriter(file)
+        self._start_time = start_time
+        # Value change prefix of each identifier code, None for scalars.
+        self._kinds = {}
+        self._cur_sig_vals = None
+        self._time = None
+
+    def enddefinitions(
+        self,
+        vcd,
+        signals,
+        cur_sig_vals
+    ):
+        out = self._out
+        self._cur_sig_vals = cur_sig_vals
+        timescale = vcd.timescale
+        if timescale:
+            out.append('$timescale {}{} $end'.format(timescale['magnitude'], timescale['unit']))
+        selected = set(vcd.signals)
+        if vcd.scopes:
+            tree = vcd.hierarchy
+        else:
+            tree = {}
+            for reference in vcd.signals:
+                *path, name = reference.split('.')
+                node = tree
+                for scope_name in path:
+                    node = node.setdefault(scope_name, {})
+                node[name] = reference
+        for line in self._scope_lines(vcd, tree, selected):
+            out.append(line)
+        out.append('$enddefinitions $end')
+        for identifier_code, signal in vcd.data.items():
+            if signal.var_type in _REAL_VAR_TYPES:
+                self._kinds[identifier_code] = 'r'
+            elif signal.var_type == 'string':
+                self._kinds[identifier_code] = 's'
+            elif signal.size == '1':
+                self._kinds[identifier_code] = None
+            else:
+                self._kinds[identifier_code] = 'b'
+
+    def _scope_lines(self, vcd, elements, selected):
+        """
+        Header lines of the variables and subscopes that contain any selected signal.
+        """
+        lines = []
+        for name, element in elements.items():
+            if isinstance(element, str):
+                if element in selected:
+                    identifier_code = vcd.references_to_ids[element]
+                    signal = vcd.data[identifier_code]
+                    # The parser joins the bit range to the name, split it back.
+                    i = name.rfind('[')
+                    if i > 0 and name.endswith(']'):
+                        name = name[:i] + ' ' + name[i:]
+                    lines.append('$var {} {} {} {} $end'.format(signal.var_type, signal.size, identifier_code, name))
+            else:
+                subelements = element.subElements if isinstance(element, Scope) else element
+                sublines = self._scope_lines(vcd, subelements, selected)
+                if sublines:
+                    lines.append('$scope module {} $end'.format(name))
+                    lines.extend(sublines)
+                    lines.append('$upscope $end')
+        return lines
+
+    def _line(self, value, identifier_code):
+        kind = self._kinds[identifier_code]
+        if kind is None and len(value) == 1:
+            return value + identifier_code
+        return (kind or 'b') + value + ' ' + identifier_code
+
+    def _dumpvars(self):
+        out = self._out
+        self._time = self._start_time
+        out.append('#{}'.format(self._time))
+        out.append('$dumpvars')
+        for identifier_code, kind in self._kinds.items():
+            value = self._cur_sig_vals.get(identifier_code, 'x')
+            if kind != 'r' or value != 'x':
+                out.append(self._line(value, identifier_code))
+        out.append('$end')
+
+    def value(
+        self,
+        vcd,
+        time,
+        value,
+        identifier_code,
+        cur_sig_vals,
+    ):
+        if time != self._time:
+            if self._time is None and self._start_time is not None:
+                self._dumpvars()
+            if time != self._time:
+                self._time = time
+                self._out.append('#{}'.format(time))
+        self._out.append(self._line(value, identifier_code))
+
+    def end(self, vcd):
+        if self._time is None and self._start_time is not None and self._cur_sig_vals is not None:
+            self._dumpvars()
+        self._out.flush()
+
+class VCDDiff(object):
+    """
+    Compare two VCD files in a single lockstep streaming pass, e.g. a golden
+    dump against a failing one, and iterate over the mismatches.
+
+    Both headers are parsed on construction, and signals are matched by
+    reference name, since identifier codes usually differ between runs.
+    Iterating then advances both files one time step at a time, without
+    storing any value changes, and after each time step, compares the signals
+    that changed in either file. Vector values are compared after extension
+    to the signal size, so that e.g. ``b10`` matches ``b0010``.
+
+    Files are only read as far as the iteration goes, so breaking out of
+    the loop, or reaching max_mismatches, stops reading both files.
+
+    :param vcd_path_a: path of the first VCD, possibly compressed
+    :type vcd_path_a: str
+
+    :param vcd_path_b: path of the second VCD, possibly compressed
+    :type vcd_path_b: str
+
+    :param signals: only compare these references. All references present
+                    in both files are compared if None.
+    :type signals: List[str]
+
+    :param max_per_signal: stop reporting the mismatches of a signal after this many
+    :type max_per_signal: int
+
+    :param max_mismatches: stop reading both files after this many mismatches in total
+    :type max_mismatches: int
+
+    :ivar vcd_a: header of the first VCD, e.g. for its timescale
+    :vartype vcd_a: VCDVCD
+
+    :ivar vcd_b: header of the second VCD
+    :vartype vcd_b: VCDVCD
+
+    :ivar references: references compared, in the definition order of the first file
+    :vartype references: List[str]
+
+    :ivar only_a: selected references that are only present in the first file
+    :vartype only_a: List[str]
+
+    :ivar only_b: selected references that are only present in the second file
+    :vartype only_b: List[str]
+    """
+    def __init__(
+        self,
+        vcd_path_a,
+        vcd_path_b,
+        signals=None,
+        max_per_signal=None,
+        max_mismatches=None,
+    ):
+        self.max_per_signal = max_per_signal
+        self.max_mismatches = max_mismatches
+        self._files = []
+        self._parsers = []
+        try:
+            for vcd_path in (vcd_path_a, vcd_path_b):
+                parser = StreamParser(store_tvs=False)
+                vcd_file = _open_vcd(vcd_path)
+                self._files.append(vcd_file)
+                VCDVCD._parse_header(vcd_file, parser)
+                self._parsers.append(parser)
+        except:
+            self.close()
+            raise
+        self.vcd_a = vcd_a = self._parsers[0].vcd
+        self.vcd_b = vcd_b = self._parsers[1].vcd
+        ids_a = vcd_a.references_to_ids
+        ids_b = vcd_b.references_to_ids
+        if signals is None:
+            self.references = [r for r in vcd_a.signals if r in ids_b]
+            self.only_a = [r for r in vcd_a.signals if r not in ids_b]
+            self.only_b = [r for r in vcd_b.signals if r not in ids_a]
+        else:
+            self.references = [r for r in signals if r in ids_a and r in ids_b]
+            self.only_a = [r for r in signals if r in ids_a and r not in ids_b]
+            self.only_b = [r for r in signals if r in ids_b and r not in ids_a]
+        # Only parse the signals that are compared.
+        for vcd, ids in ((vcd_a, ids_a), (vcd_b, ids_b)):
+            keep = set(ids[r] for r in self.references)
+            for identifier_code in list(vcd.data):
+                if identifier_code not in keep:
+                    del vcd.data[identifier_code]
+
+    def __iter__(self):
+        """
+        :return: mismatches as (time, reference, value_a, value_b), sorted by
+                 time, and then by definition order of the references
+        :rtype: Iterator[Tuple[int,str,str,str]]
+        """
+        references = self.references
+        vcd_a = self.vcd_a
+        vcd_b = self.vcd_b
+        # Indexes of the compared references of each identifier code, for each file.
+        pairs_a = {}
+        pairs_b = {}
+        sizes = []
+        for i, reference in enumerate(references):
+            identifier_code_a = vcd_a.references_to_ids[reference]
+            identifier_code_b = vcd_b.references_to_ids[reference]
+            pairs_a.setdefault(identifier_code_a, []).append(i)
+            pairs_b.setdefault(identifier_code_b, []).append(i)
+            signal_a = vcd_a.data[identifier_code_a]
+            if signal_a.var_type in _UNPACKED_VAR_TYPES:
+                sizes.append(None)
+            else:
+                sizes.append(int(signal_a.size))
+        values_a = ['x'] * len(references)
+        values_b = ['x'] * len(references)
+        counts = [0] * len(references)
+        max_per_signal = self.max_per_signal
+        remaining = self.max_mismatches
+        steps_a = self._parsers[0].iter_times(self._files[0])
+        steps_b = self._parsers[1].iter_times(self._files[1])
+        try:
+            step_a = next(steps_a, None)
+            step_b = next(steps_b, None)
+            while step_a is not None or step_b is not None:
+                if step_b is None or (step_a is not None and step_a[0] <= step_b[0]):
+                    time = step_a[0]
+                else:
+                    time = step_b[0]
+                changed = set()
+                if step_a is not None and step_a[0] == time:
+                    for identifier_code, value in step_a[1]:
+                        for i in pairs_a[identifier_code]:
+                            values_a[i] = value
+                            changed.add(i)
+                    step_a = next(steps_a, None)
+                if step_b is not None and step_b[0] == time:
+                    for identifier_code, value in step_b[1]:
+                        for i in pairs_b[identifier_code]:
+                            values_b[i] = value
+                            changed.add(i)
+                    step_b = next(steps_b, None)
+                for i in sorted(changed):
+                    value_a = values_a[i]
+                    value_b = values_b[i]
+                    if value_a == value_b or _vcd_values_equal(value_a, value_b, sizes[i]):
+                        continue
+                    if max_per_signal is not None:
+                        if counts[i] >= max_per_signal:
+                            continue
+                        counts[i] += 1
+                    yield time, references[i], value_a, value_b
+                    if remaining is not None:
+                        remaining -= 1
+                        if remaining <= 0:
+                            return
+        finally:
+            steps_a.close()
+            steps_b.close()
+            self.close()
+
+    def close(self):
+        """
+        Close both files. Done automatically once the iteration is over.
+        """
+        for vcd_file in self._files:
+            vcd_file.close()
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def iter_batch(vcd_paths, function=None, processes=None, **kwargs):
+    """
+    Run the same extraction on many VCD files, in a pool of worker processes.
+
+    Each file is parsed in a worker with ``VCDVCD(vcd_path, **kwargs)``, and
+    only the result of the extraction is sent back, as soon as it is ready.
+    At most twice as many files as there are processes are in flight at
+    a time, so that results are streamed back instead of piling up.
+
+    Failures are isolated per file: an exception raised while parsing or
+    extracting, and even the crash of a worker, only fails the files that
+    were being processed at that time, and the others go on.
+
+    :param vcd_paths: paths of the VCD files, or a glob pattern such as ``'runs/**/*.vcd'``
+    :type vcd_paths: Union[str,Iterable[str]]
+
+    :param function: picklable function, called in the worker with the parsed VCDVCD,
+                     whose return value is the result for that file, e.g. a :class:`SignalSummary`.
+                     If None, the result is the callbacks given in kwargs,
+                     as left by the parse of the file.
+    :type function: Callable[[VCDVCD],Any]
+
+    :param processes: number of worker processes, os.cpu_count() if None.
+                      If 1, files are processed one after the other in this process.
+    :type processes: int
+
+    :param kwargs: arguments of :class:`VCDVCD`, e.g. signals or store_tvs.
+                   A callbacks object is copied for each file.
+
+    :return: (vcd_path, result, error) for each file, in completion order, where error
+             is the exception that made the file fail, and result is None if it failed.
+    :rtype: Iterator[Tuple[str,Any,Union[NoneType,Exception]]]
+    """
+    if isinstance(vcd_paths, str):
+        vcd_paths = sorted(glob.glob(vcd_paths, recursive=True))
+    if function is None and kwargs.get('callbacks') is None:
+        raise ValueError('iter_batch needs a function or callbacks')
+    if processes is None:
+        processes = os.cpu_count() or 1
+    pending = iter(vcd_paths)
+    if processes == 1:
+        for vcd_path in pending:
+            # Same as the pickling to a worker, so that files do not share state.
+            result, error = _batch_worker(copy.deepcopy((vcd_path, function, kwargs)))
+            yield vcd_path, result, error
+        return
+    executor = None
+    futures = {}
+    try:
+        while True:
+            if executor is None:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+            for vcd_path in pending:
+                futures[executor.submit(_batch_worker, (vcd_path, function, kwargs))] = vcd_path
+                if len(futures) >= 2 * processes:
+                    break
+            if not futures:
+                break
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                vcd_path = futures.pop(future)
+                try:
+                    result, error = future.result()
+                except concurrent.futures.BrokenExecutor as e:
+                    # A worker died, e.g. out of memory: the files in flight fail,
+                    # and the others go on in a new pool.
+                    result, error = None, e
+                    if executor is not None:
+                        executor.shutdown(wait=False)
+                        executor = None
+                yield vcd_path, result, error
+            if executor is None:
+                for future, vcd_path in futures.items():
+                    yield vcd_path, None, concurrent.futures.process.BrokenProcessPool(
+                        'a worker process died while this file was being processed')
+                futures = {}
+    finally:
+        if executor is not None:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+def _batch_worker(args):
+    vcd_path, function, kwargs = args
+    try:
+        vcd = VCDVCD(vcd_path, **kwargs)
+        if function is None:
+            result = kwargs['callbacks']
+        else:
+            result = function(vcd)
+        return result, None
+    # The parser exits on some malformed headers.
+    except (Exception, SystemExit) as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError('{}: {}'.format(type(e).__name__, e))
+        return None, e
+
+class SignalSummary(object):
+    """
+    Picklable extraction for :func:`iter_batch`, which summarizes some signals
+    of a parsed VCD as plain data.
+
+    :param signals: patterns of the signals to summarize, all signals if None
+    :type signals: List[str]
+
+    :param mode: how signals are matched, see :func:`VCDVCD.select`
+    :type mode: str
+
+    :param times: also give the value of each signal at these sorted times
+    :type times: List[int]
+
+    :return: for each selected reference, a dict with the number of value ``changes``,
+             the ``last`` value, and the ``values`` at the given times, if any
+    :rtype: Dict[str,Dict[str,Any]]
+    """
+    def __init__(self, signals=None, mode='substring', times=None):
+        self.signals = signals
+        self.mode = mode
+        self.times = times
+
+    def __call__(self, vcd):
+        if self.signals is None:
+            references = vcd.signals
+        else:
+            references = []
+            for pattern in self.signals:
+                references.extend(vcd.select(pattern, self.mode))
+        summary = {}
+        for reference in references:
+            signal = vcd[reference]
+            entry = summary[reference] = {
+                'changes': len(signal.times),
+                'last': signal._value_at_index(len(signal.times) - 1) if len(signal.times) else None,
+            }
+            if self.times:
+                entry['values'] = signal.sample(self.times)
+        return summary
+
+def _vcd_values_equal(a, b, size):
+    """
+    Compare two values of a signal of the given number of bits, taking into account
+    the VCD left extension of shorter vector values: with x or z if the value starts
+    with x or z, and with 0 otherwise.
+
+    Values of real and other non bit vector variables are compared as is, if size is None.
+    """
+    if size is None or len(a) == len(b) or max(len(a), len(b)) > size:
+        return a == b
+    return _extend_value(a, size) == _extend_value(b, size)
+
+def _extend_value(value, size):
+    """
+    Left extend a bit vector value to size bits as VCD does.
+    """
+    pad = value[0] if value[0] in 'xXzZ' else '0'
+    return pad * (size - len(value)) + value
 
 def binary_string_to_hex(s):
     """
@@ -546,12 +3953,32 @@ def binary_string_to_hex(s):
             return c
     return hex(int(s, 2))[2:]
 
+def _value_to_number(value, real=False):
+    """
+    Convert a value string to a number.
+
+    :return: the number, and True if the value has x or z bits, in which case the number is 0
+    :rtype: Tuple[Union[int,float],bool]
+    """
+    if isinstance(value, FourStateValue):
+        if value.xz:
+            return 0, True
+        return value.bits, False
+    if real:
+        try:
+            return float(value), False
+        except ValueError:
+            return 0.0, True
+    if value.strip('01'):
+        return 0, True
+    return int(value, 2), False
+
 def condition_signal_tv(tv):
     x, y = list(zip(*tv))
     if not isinstance(y[0], int):
-        make_bin_to_int = lambda x : int(x, base=2)
-        #x = map(make_bin_to_int, x)
-        y = list(map(make_bin_to_int, y))
+        # Convert each distinct value only once.
+        make_bin_to_int = {v: int(v, base=2) for v in set(y)}
+        y = list(map(make_bin_to_int.__getitem__, y))
     tv = list(zip(x, y))
     return tv
 
@@ -570,25 +3997,22 @@ Returns:
 '''
 def expand_signal(xin, yin, length=None):
     import numpy as np
-    import pandas as pd
-    xin = list(xin)
+    x = np.asarray(xin)
+    y = np.asarray(yin)
     if not length:
-        length = max(xin)+1
+        length = x.max()+1
 
     # Select all points less than length, then add last point, extrapolting that the last point has no transitions
     # This will always result in an accurate frame of the desired length
-    df = pd.DataFrame({"x": xin, "y": yin})
-    df = df[df["x"] < length]
-    df.loc[len(df)] = {'x': length-1, "y": list(df["y"])[-1]}
+    keep = x < length
+    x = np.append(x[keep], length-1)
+    y = y[keep]
+    y = np.append(y, y[-1:])
 
     # At the transition add a double x point at the initial value before the change index
-    dout = {"x": [], "y": []}
-    for thisr, nextr in zip(df.iterrows(), list(df.iterrows())[1:]):
-        _, next = nextr
-        _, this = thisr
-        dout["x"].append(this["x"])
-        dout["y"].append(this["y"])
-
-        dout["x"].append(next["x"])
-        dout["y"].append(this["y"])
-    return dout['x'], dout['y']
+    n = len(x) - 1
+    x_ex = np.empty(2 * n, dtype=x.dtype)
+    x_ex[0::2] = x[:-1]
+    x_ex[1::2] = x[1:]
+    y_ex = np.repeat(y[:-1], 2)
+    return x_ex.tolist(), y_ex.tolist()